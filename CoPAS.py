@@ -25,6 +25,17 @@ EXECUTION EXAMPLE:
     CoPAS.py -s ADPAA
   Install or update all package, onlye source versions:
     CoPAS.py -S
+  Clone/pull all repositories, four at a time:
+    CoPAS.py -j 4
+  Clone only the latest LROSE commit:
+    CoPAS.py --clone LROSE=shallow LROSE
+  Prefetch updates in the background every hour:
+    CoPAS.py --daemon 3600
+  Download everything now, update the installed packages later:
+    CoPAS.py --fetch-only
+    CoPAS.py --apply
+  Check out SODA tag v3.0 next to the current version, as SODA@v3.0:
+    CoPAS.py --add-version SODA=v3.0
 
 SYNTAX:
   CoPAS.py <-h|-s|-t> <ADPAA> <ADTAE> <DRILSDOWN> <EGADS> <SAMAC> <SIMDATA> <SODA> <UIOPS> <nobinary> <notesting>
@@ -32,6 +43,31 @@ SYNTAX:
   <-S>    - Install source package but no binary package.
   <-s>    - Install source package in addition to binary package.
   <-t>    - Test for necessary support packages.
+  <-j N>  - Run up to N install steps at the same time.
+  <--clone [PACKAGE=]STRATEGY> - Clone strategy (full, shallow[:N], partial,
+            sparse:DIR,...) for all git packages or only PACKAGE.
+  <--segments N> - Download large files over N connections at once.
+  <--writers N>  - Write extracted files with N threads.
+  <--export-bundle FILE> - Write an offline bundle (git bundles, ADPAA.tar.gz,
+            ADPAA source export and revision manifest) to FILE.
+  <--from-bundle FILE>   - Install or update packages from an offline bundle.
+  <--fresh SECONDS> - Do not check packages again that were checked less
+            than SECONDS ago (default 300, 0 always checks).
+  <--report FILE> - Write the time, bytes and throughput of every package
+            phase as JSON to FILE.
+  <--watch SECONDS>  - Prefetch git objects and archives into the local
+            caches every SECONDS, without changing the installed packages.
+  <--daemon SECONDS> - As --watch, in the background (log in the cache
+            directory).
+  <--fetch-only> - Download git objects, archives and data sets into the
+            local caches without changing the installed packages.
+  <--apply>      - Update the installed packages from the local caches
+            only, without network (after --fetch-only).
+  <--add-version PACKAGE=REF[:NAME]> - Check out tag, branch or commit REF
+            of a git package as version NAME (default REF) in PACKAGE@NAME,
+            sharing the objects of the PACKAGE clone.
+  <--remove-version PACKAGE=NAME> - Remove version NAME of PACKAGE.
+  <--list-versions> - List the versions checked out next to each package.
   ADPAA     - Clone/pull the ADPAA SVN repository.
   ADTAE     - Clone/pull the ADTAE Git repository.
   DRILSDOWN - Clone/pull the DRILSDOWN repository.
@@ -44,8 +80,13 @@ SYNTAX:
   COYOTE    - Install the Coyote package.
 <nobinary>  - Do not install binary packages.
   <notesting> - Do not test for support packages.
+  <stream>    - Extract binary packages while they download.
+  <keeparchive> - With stream, keep a copy of the downloaded archive.
+  <nocheck>   - Pull and update repositories without first asking whether
+                the remote has changed.
 
-  No parameter on command line then Clone/pull all repositories.
+  Package names are not case sensitive.  No package on command line then
+  Clone/pull all repositories.
 
 DEVELOPERS:
   David Delene <delene@aero.und.edu>
@@ -348,54 +389,330 @@ COPYRIGHT:
 
 try:
     import sys
+    import time
 except ImportError:
     print ("    Required python 'sys' module is not installed.")
     quit()
- 
+startup_time = time.time()
+
+# Standard library modules used throughout CoPAS.
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import urllib.parse
+
+# Directory for the download and module probe caches.
+cache_directory = os.environ.get('COPAS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'CoPAS'))
+
 # Define all default options values.
 binary       = 1
 source       = 0
 testing      = 1
 testing_only = 0
-
-# Turn off all packages by default.
-adpaa        = 0
-adtae        = 0
-aospy        = 0
-drilsdown    = 0
-eufar        = 0
-lrose        = 0
-samac        = 0
-simdata      = 0
-soda         = 0
-uiops        = 0
-coyote       = 0
-
-# Routine to turn on/off all packages.
-def all_packages(status):
-    if status == 'On': 
-        adpaa     = 1
-        adtae     = 1
-        drilsdown = 1
-        eufar     = 1
-        lrose     = 1
-        samac     = 1
-        simdata   = 1
-        soda      = 1
-        uiops     = 1
-        coyote    = 1
-    else:
-        adpaa     = 0
-        adtae     = 0
-        drilsdown = 0
-        eufar     = 0
-        lrose     = 0
-        samac     = 0
-        simdata   = 0
-        soda      = 0
-        uiops     = 0
-        coyote    = 0
-    return (adpaa,adtae,drilsdown,eufar,lrose,samac,soda,uiops,coyote)
+jobs         = 1
+download_segments = 1
+extract_workers   = 1
+export_path       = None
+bundle_path       = None
+state_fresh       = 300
+report_path       = None
+watch_interval    = None
+daemon            = 0
+phase             = None
+version_adds      = []
+version_removes   = []
+list_versions     = 0
+stream       = 0
+keep_archive = 0
+remote_check = 1
+
+# Clone strategy for each git package (see clone_options), changed with the
+# --clone option.  Packages not listed get the '*' entry, or full history.
+clone_strategies = {
+    'LROSE': 'partial',
+}
+
+# Convert a clone strategy into git clone options:
+#   full            - Complete history and all file contents.
+#   shallow[:N]     - Only the last N commits (default 1), git clone --depth.
+#   partial         - All commits, file contents fetched on demand,
+#                     git clone --filter=blob:none.
+#   sparse:DIR,...  - Partial clone with only the listed directories
+#                     checked out (git sparse-checkout).
+def clone_options(strategy):
+    mode, _, value = strategy.partition(':')
+    if mode == 'full' and not value:
+        return {}
+    if mode == 'shallow':
+        if not value:
+            value = '1'
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError("Shallow clone depth must be a positive number, not '"+value+"'.")
+        return {'depth': int(value)}
+    if mode in ('partial', 'blobless') and not value:
+        return {'filter': 'blob:none'}
+    if mode == 'sparse' and value:
+        return {'filter': 'blob:none', 'sparse': True}
+    raise ValueError("Unknown clone strategy '"+strategy+"', use full, shallow[:N], partial or sparse:DIR,...")
+
+# Clone strategy for a git package.
+def clone_strategy(package):
+    return clone_strategies.get(package.upper(), clone_strategies.get('*', 'full'))
+
+# Description of one package: its name and the other names accepted on the
+# command line, how it is fetched ('http' archive, 'git' repository, 'pip'
+# install or 'ftp' data set), where from (url) and to (directory), the
+# packages it needs first, and an optional svn source repository used with
+# -s and -S.  The archive of an 'http' package is checked against a pinned
+# SHA-256 (sha256) or one published in sha256sum format at checksum_url.
+# Packages with default set are installed when no package is named on the
+# command line.
+class Package:
+    def __init__(self, name, heading, fetch, url, directory, aliases=(),
+                 depends=(), artifact=None, source_url=None, default=True,
+                 sha256=None, checksum_url=None):
+        self.name       = name
+        self.heading    = heading
+        self.fetch      = fetch
+        self.url        = url
+        self.directory  = directory
+        self.aliases    = list(aliases)
+        self.depends    = list(depends)
+        self.artifact   = artifact
+        self.source_url = source_url
+        self.default    = default
+        self.sha256       = sha256
+        self.checksum_url = checksum_url
+        # Set when installing from an offline bundle (--from-bundle): the
+        # bundled git bundle or archive, and the bundled svn source export.
+        self.bundle        = None
+        self.bundle_info   = {}
+        self.bundle_source = None
+
+def sourceforge_url(svn_url, ssh_url):
+    user = os.environ.get('SVN_USERNAME') or os.environ.get('SOURCEFORGE_USER')
+    if user is None:
+        return svn_url
+    return ssh_url.replace('USER', user)
+
+def sourceforge_git_url(anonymous_url, ssh_url):
+    user = os.environ.get('SOURCEFORGE_USER')
+    if user is None:
+        return anonymous_url
+    return ssh_url.replace('USER', user)
+
+# All packages CoPAS knows about, in installation order.
+registry = [
+    Package('ADPAA',
+        "  Working on Airborne Data Processing and Analysis (ADPAA) package.",
+        'http', "http://sourceforge.net/projects/adpaa/files/ADPAA.tar.gz/download",
+        'ADPAA', artifact='ADPAA.tar.gz',
+        source_url=sourceforge_url('svn://svn.code.sf.net/p/adpaa/code/trunk/src',
+                                   'svn+ssh://USER@svn.code.sf.net/p/adpaa/code/trunk/src')),
+    Package('ADTAE',
+        "  Working on Airborne Data Testing and Evaluation (ADTAE) package.",
+        'git', sourceforge_git_url('git://git.code.sf.net/p/adtae/code',
+                                   'ssh://USER@git.code.sf.net/p/adtae/code'),
+        'ADTAE'),
+    Package('AOSPY', None, 'pip', 'aospy', None, default=False),
+    Package('DRILSDOWN',
+        "  Working on DRILSDOWN package.",
+        'git', 'git://github.com/Unidata/drilsdown.git', 'DRILSDOWN'),
+    Package('EUFAR',
+        "  Working on EUFAR General Airborne Data-processing Software (EUFAR) package.",
+        'git', 'https://github.com/eufarn7sp/egads-eufar', 'EUFAR', aliases=['EGADS']),
+    # LROSE builds against the lrose-netcdf clone.
+    Package('NetCDF',
+        "  Working on the NetCDF support for (LROSE).",
+        'git', 'https://github.com/NCAR/lrose-netcdf', 'NetCDF'),
+    Package('LROSE',
+        "  Working on the LROSE Lidar Radar Open Software Environment (LROSE).",
+        'git', 'https://github.com/NCAR/lrose-core', 'LROSE', depends=['NetCDF']),
+    Package('SAMAC',
+        "  Software for Airborne Measurements of Aerosol and Clouds (SAMAC).",
+        'git', 'https://github.com/StephGagne/SAMAC', 'SAMAC'),
+    Package('SIMDATA',
+        "  Working on the NCAR probe simulation data set (SIMDATA).",
+        'ftp', 'ftp://ftp.ucar.edu/pub/mmm/bansemer/simulations/', 'SIMDATA'),
+    Package('SODA',
+        "  System for OAP Data Analysis (SODA) package.",
+        'git', 'https://github.com/abansemer/soda2', 'SODA'),
+    Package('UIOPS',
+        "  UIOPS  Process University of Illinois OAP Processing Software (UOIPS) package.",
+        'git', 'https://github.com/joefinlon/UIOPS', 'UIOPS', aliases=['UOIPS']),
+    Package('Coyote',
+        "  Coyote (IDL) Graphics Package.",
+        'git', 'https://github.com/idl-coyote/coyote', 'Coyote'),
+]
+
+# URL overrides for local mirrors and the offline benchmark
+# (CoPAS_benchmark.py): COPAS_URL_<NAME> replaces a package's URL and
+# COPAS_SOURCE_URL_<NAME> its svn source URL, for example
+# COPAS_URL_SAMAC=file:///srv/git/SAMAC.git.  COPAS_SHA256_<NAME> pins the
+# checksum of the package's archive.
+for package in registry:
+    package.url = os.environ.get('COPAS_URL_'+package.name.upper(), package.url)
+    package.source_url = os.environ.get('COPAS_SOURCE_URL_'+package.name.upper(), package.source_url)
+    package.sha256 = os.environ.get('COPAS_SHA256_'+package.name.upper(), package.sha256)
+
+# Find a package by name or alias, ignoring case.
+def find_package(name):
+    for package in registry:
+        if name.upper() in [package.name.upper()] + [alias.upper() for alias in package.aliases]:
+            return package
+    return None
+
+# The named packages plus the packages they depend on, in registry order.
+def select_packages(names):
+    wanted = set()
+    def add(name):
+        if name not in wanted:
+            wanted.add(name)
+            for dependency in find_package(name).depends:
+                add(dependency)
+    for name in names:
+        add(name)
+    return [package for package in registry if package.name in wanted]
+
+# Suggested install commands for the svn command line client.
+svn_hints = ["Redhat - sudo yum install subversion",
+             "Fedora - sudo dnf install subversion",
+             "Ubuntu - sudo apt install subversion"]
+
+# Python modules used by CoPAS, the packages or fetch types that need them
+# and suggested install commands.
+support_modules = [
+    ('git', ['git'],
+        ["Fedora - sudo dnf install python3-GitPython",
+         "Ubuntu - sudo apt install python3-git"]),
+    ('numpy', ['ADPAA'],
+        ["Redhat - sudo yum install python3-numpy",
+         "Fedora - sudo dnf install python3-numpy",
+         "Ubuntu - sudo apt install python3-numpy"]),
+    ('pip', ['pip'],
+        ["Fedora - sudo dnf install python3-pip",
+         "Ubuntu - sudo apt install python3-pip"]),
+    ('requests', ['http'],
+        ["Redhat - sudo yum install python3-requests",
+         "Fedora - sudo dnf install python3-requests",
+         "Ubuntu - sudo apt install python3-requests"]),
+    ('urllib3', ['http'],
+        ["Redhat - sudo yum install python-urllibs3",
+         "Fedora - sudo dnf install python3-urllibs3"]),
+]
+
+# Python modules the packages themselves need at run time, checked by each
+# package's verify step.
+package_requirements = {
+    'ADPAA': ['csv', 'numpy', 'math', 'sys'],
+}
+
+# Module lookups are cached in probes.json in the cache directory, keyed by
+# a fingerprint of the interpreter and its module search path, so repeated
+# runs in the same environment do not search sys.path again.  The
+# probe_entries most recently updated environments are kept, so several
+# interpreters (system python, a venv) can share the cache.
+probe_lock    = threading.Lock()
+probe_results = None
+probe_entries = 8
+
+# Fingerprint of the interpreter, sys.path and the mtimes of the sys.path
+# directories; installing or removing a module changes a directory mtime.
+# The script's own directory (the install root) is left out of the mtimes
+# since CoPAS itself changes it.
+def probe_fingerprint():
+    digest = hashlib.sha256()
+    digest.update((sys.executable+'\n'+sys.version+'\n').encode())
+    for entry in sys.path:
+        digest.update((entry+'\n').encode())
+        if not entry or entry == sys.path[0]:
+            continue
+        try:
+            digest.update(str(os.stat(entry).st_mtime_ns).encode())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+# Return {module: found} for the named modules, using importlib.util.find_spec
+# (no module code is executed) for modules not in the probe cache.
+def find_modules(modules):
+    global probe_results
+    with probe_lock:
+        probe_name = os.path.join(cache_directory, 'probes.json')
+        key = probe_fingerprint()
+        if probe_results is None:
+            try:
+                with open(probe_name) as probe_file:
+                    cached = json.load(probe_file)
+            except (IOError, ValueError):
+                cached = {}
+            probe_results = cached.get(key, {})
+        missing = [module for module in modules if module not in probe_results]
+        for module in missing:
+            try:
+                probe_results[module] = importlib.util.find_spec(module) is not None
+            except (ImportError, ValueError):
+                probe_results[module] = False
+        if missing:
+            # Merge into the cache file as it is now (another interpreter
+            # may have written it), newest environment last, dropping the
+            # oldest beyond probe_entries.
+            try:
+                with open(probe_name) as probe_file:
+                    cached = json.load(probe_file)
+            except (IOError, ValueError):
+                cached = {}
+            cached.pop(key, None)
+            cached[key] = probe_results
+            while len(cached) > probe_entries:
+                del cached[next(iter(cached))]
+            try:
+                if not os.path.isdir(cache_directory):
+                    os.makedirs(cache_directory)
+                with open(probe_name+'.tmp.'+str(os.getpid()), 'w') as probe_file:
+                    json.dump(cached, probe_file, indent=1)
+                os.replace(probe_name+'.tmp.'+str(os.getpid()), probe_name)
+            except (IOError, OSError):
+                pass
+        return dict((module, probe_results[module]) for module in modules)
+
+# Report whether the support modules needed by the packages (all modules
+# when packages is None) can be found, without importing them.
+def check_support_modules(packages):
+    needs = set()
+    for package in packages or []:
+        needs.update([package.name, package.fetch])
+        if package.source_url and source:
+            needs.add('svn')
+    checked = [entry for entry in support_modules
+               if packages is None or set(entry[1]) & needs]
+    found = find_modules([entry[0] for entry in checked])
+    for module, users, hints in checked:
+        if not found[module]:
+            print ("**  WARNING:  The python '"+module+"' module does not exists.")
+            print ("**    Needed for "+", ".join(users)+".")
+            print ("**    Please install (see suggestion below) and execute again.")
+            for hint in hints:
+                print ("**    "+hint)
+        else:
+            print ("  The "+module+" module is available.")
+    # svn source checkouts run the svn command line client.
+    if packages is None or 'svn' in needs:
+        if shutil.which('svn') is None:
+            print ("**  WARNING:  The 'svn' command does not exists.")
+            print ("**    Needed for svn source checkouts (-s, -S).")
+            print ("**    Please install (see suggestion below) and execute again.")
+            for hint in svn_hints:
+                print ("**    "+hint)
+        else:
+            print ("  The svn command is available.")
 
 # Define the help/syntax message.
 def help_message():
@@ -405,12 +722,45 @@ def help_message():
     print ("    -S        Include source code but no binary installation.")
     print ("    -s        Include source code in addition to binary installation.")
     print ("    -t        Only test for necessary support packages.")
-    print ("  PACKAGES INCLUDED (Default - All Packages):")
+    print ("    -j N      Run up to N download/extract/clone/pull steps at the same time (default 1).")
+    print ("    --clone [PACKAGE=]STRATEGY")
+    print ("              Clone strategy for all or one git package: full, shallow[:N],")
+    print ("              partial (no file contents until needed) or sparse:DIR,DIR,...")
+    print ("    --segments N")
+    print ("              Download large files over N connections at once (default 1).")
+    print ("    --writers N")
+    print ("              Write extracted files with N threads (default 1).")
+    print ("    --export-bundle FILE")
+    print ("              Write an offline bundle of the installed packages to FILE.")
+    print ("    --from-bundle FILE")
+    print ("              Install or update packages from an offline bundle, without network.")
+    print ("    --fresh SECONDS")
+    print ("              Skip packages checked less than SECONDS ago and unchanged since (default 300).")
+    print ("    --report FILE")
+    print ("              Write a JSON report of each package phase (time, bytes, throughput) to FILE.")
+    print ("    --watch SECONDS")
+    print ("              Keep prefetching git objects and archives every SECONDS, without")
+    print ("              changing the installed packages; a later run only applies them.")
+    print ("    --daemon SECONDS")
+    print ("              As --watch, detached in the background, logging to daemon.log in the cache.")
+    print ("    --fetch-only")
+    print ("              Download git objects, archives and data sets into the local caches only.")
+    print ("    --apply   Fast-forward clones and extract archives from the local caches, without")
+    print ("              network; run after --fetch-only.")
+    print ("    --add-version PACKAGE=REF[:NAME]")
+    print ("              Check out tag, branch or commit REF of a git package as version NAME")
+    print ("              (default REF) in the PACKAGE@NAME directory, sharing the objects of")
+    print ("              the PACKAGE clone, so only the files take space.")
+    print ("    --remove-version PACKAGE=NAME")
+    print ("              Remove the PACKAGE@NAME version.")
+    print ("    --list-versions")
+    print ("              List the versions checked out for the (or all) git packages.")
+    print ("  PACKAGES INCLUDED (Default - All Packages, names are not case sensitive):")
     print ("    ADPAA     Process Airborne Data Processing and Analysis (ADPAA) package.")
     print ("    ADTAE     Process Airborne Data Testing and Evaluation (ADTAE) package.")
-    print ("    EUFAR     Process EUFAR General Airborne Data-processing Software (EUFAR) package.")
+    print ("    EUFAR     Process EUFAR General Airborne Data-processing Software (EUFAR) package, also EGADS.")
     print ("    DRILSDOWN Process Drawing Rich Integrated Lat-lon-time Subsets from Dataservers Online into Working Notebooks (DRILSDOWN).")
-    print ("    LROSE     The Lidar Radar Open Software Environment (LROSE) package.")
+    print ("    LROSE     The Lidar Radar Open Software Environment (LROSE) package, includes NetCDF.")
     print ("    SAMAC     Software for Airborne Measurements of Aerosol and Clouds (SAMAC) package.")
     print ("    SIMDATA   Simulation probe data set.")
     print ("    SODA      System for OAP Data Analysis (SODA) package.")
@@ -419,517 +769,2434 @@ def help_message():
     print ("  PREFERENCES:")
     print ("    nobinary  Do not install binary packages.")
     print ("    notesting Do not test for support packages.")
+    print ("    stream    Extract binary packages while downloading, without storing the archive.")
+    print ("    keeparchive With stream, also keep a copy of the archive in the download cache.")
+    print ("    nocheck   Always pull and update, without first checking whether the remote changed.")
     print ("  ENIVIRONMENTAL VARIABLES:")
     print ("    SVN_USERNAME     Checks out svn repositories using the defiend username.")
     print ("    SOURCEFORGE_USER Checks out Sourceforge git repositories using defiend username.")
-
-# Turn off all packages by default.
-adpaa,adtae,drilsdown,eufar,lrose,samac,soda,uiops,coyote = all_packages('Off')
+    print ("    COPAS_CACHE      Download cache directory (default ~/.cache/CoPAS).")
+    print ("    COPAS_CACHE_MB   Download cache size limit in megabytes (default 4096).")
+    print ("    COPAS_MIRRORS    Directory of shared git mirrors used by all install roots.")
+    print ("    COPAS_URL_<NAME> Download or clone package NAME from this URL instead.")
+    print ("    COPAS_SOURCE_URL_<NAME> Check out the svn source of package NAME from this URL instead.")
+    print ("    COPAS_SHA256_<NAME> SHA-256 the archive of package NAME must have.")
+
+# Check for options that take a value (-j N, --clone STRATEGY, --segments N,
+# --writers N, --export-bundle FILE, --from-bundle FILE); remove them from the
+# argument list so the package selection below behaves the same with or
+# without them.
+args = [sys.argv[0]]
+index = 1
+while index < len(sys.argv):
+    param = sys.argv[index]
+    if (param.startswith('-j') or param.startswith('--clone') or
+            param.startswith('--segments') or param.startswith('--writers') or
+            param.startswith('--export-bundle') or param.startswith('--from-bundle') or
+            param.startswith('--fresh') or param.startswith('--report') or
+            param.startswith('--watch') or param.startswith('--daemon') or
+            param.startswith('--add-version') or param.startswith('--remove-version')):
+        if param.startswith('-j'):
+            option, value = '-j', param[2:]
+        else:
+            option, _, value = param.partition('=')
+        if not value and index + 1 < len(sys.argv):
+            index += 1
+            value = sys.argv[index]
+        if option == '-j':
+            if not value.isdigit() or int(value) < 1:
+                print ("**  ERROR:  The -j option requires a positive number of jobs.")
+                exit(1)
+            jobs = int(value)
+        elif option == '--segments':
+            if not value.isdigit() or int(value) < 1:
+                print ("**  ERROR:  The --segments option requires a positive number of connections.")
+                exit(1)
+            download_segments = int(value)
+        elif option == '--writers':
+            if not value.isdigit() or int(value) < 1:
+                print ("**  ERROR:  The --writers option requires a positive number of threads.")
+                exit(1)
+            extract_workers = int(value)
+        elif option == '--fresh':
+            if not value.isdigit():
+                print ("**  ERROR:  The --fresh option requires a number of seconds.")
+                exit(1)
+            state_fresh = int(value)
+        elif option == '--report':
+            report_path = value
+        elif option in ('--watch', '--daemon'):
+            if not value.isdigit() or int(value) < 1:
+                print ("**  ERROR:  The "+option+" option requires a positive number of seconds.")
+                exit(1)
+            watch_interval = int(value)
+            daemon = option == '--daemon'
+        elif option in ('--add-version', '--remove-version'):
+            name, _, ref = value.partition('=')
+            package = find_package(name)
+            if package is None or package.fetch != 'git' or not ref:
+                print ("**  ERROR:  The "+option+" option requires a git package and a version, PACKAGE=VERSION.")
+                exit(1)
+            if option == '--add-version':
+                ref, _, name = ref.partition(':')
+                version_adds.append((package, ref, (name or ref).replace('/', '-')))
+            else:
+                version_removes.append((package, ref))
+        elif option == '--export-bundle':
+            export_path = value
+        elif option == '--from-bundle':
+            if not os.path.isfile(value):
+                print ("**  ERROR:  The offline bundle "+value+" does not exist.")
+                exit(1)
+            bundle_path = value
+        elif option == '--clone':
+            package, _, strategy = value.rpartition('=')
+            try:
+                clone_options(strategy)
+            except ValueError as exc:
+                print ("**  ERROR:  "+str(exc))
+                exit(1)
+            if package:
+                found = find_package(package)
+                if found is None or found.fetch != 'git':
+                    print ("**  ERROR:  The --clone option needs a git package, not '"+package+"'.")
+                    exit(1)
+                clone_strategies[found.name.upper()] = strategy
+            else:
+                # One strategy for every git package.
+                clone_strategies.clear()
+                clone_strategies['*'] = strategy
+        else:
+            print ("**  ERROR:  Unknown option "+param+", see CoPAS.py -h.")
+            exit(1)
+    else:
+        args.append(param)
+    index += 1
+sys.argv = args
 
 # Check for - command line options, for example -h.
-for param in sys.argv:
+for param in sys.argv[1:]:
     if param.startswith('-h'):
         help_message()
         exit()
     if param.startswith('-S'):
         source = 1
         binary = 0
-        # If no parameter options, install all packages.
-        if (len(sys.argv) < 3):
-            adpaa,adtae,drilsdown,eufar,lrose,samac,soda,uiops = all_packages('On')
     if param.startswith('-s'):
         source = 1
-        # If no parameter options, install all packages.
-        if (len(sys.argv) < 3):
-            adpaa,adtae,drilsdown,eufar,lrose,samac,soda,uiops,coyote = all_packages('On')
-    else:
-        # If no parameter options, install all packages.
-        if (len(sys.argv) < 2):
-            adpaa,adtae,drilsdown,eufar,lrose,samac,soda,uiops,coyote = all_packages('On')
-
     if param.startswith('-t'):
         testing_only  = 1
+    if param == '--list-versions':
+        list_versions = 1
+    if param in ('--fetch-only', '--apply'):
+        if phase is not None and phase != param[2:]:
+            print ("**  ERROR:  The --fetch-only and --apply options can not be used together.")
+            exit(1)
+        phase = param[2:]
+    if param.startswith('-') and not (
+            param[:2] in ('-h', '-S', '-s', '-t') or
+            param in ('--list-versions', '--fetch-only', '--apply')):
+        print ("**  ERROR:  Unknown option "+param+", see CoPAS.py -h.")
+        exit(1)
+
+# Check for list of packages to install; if none are named, install all
+# default packages.
+# Anything that is neither an option, a preference nor a package name is
+# an error, so a misspelt package does not install all packages.
+preferences = ['nobinary', 'notesting', 'stream', 'keeparchive', 'nocheck']
+names = []
+for param in sys.argv[1:]:
+    package = find_package(param)
+    if package is not None:
+        names.append(package.name)
+    elif not param.startswith('-') and param not in preferences:
+        print ("**  ERROR:  Unknown package or preference "+param+", see CoPAS.py -h.")
+        exit(1)
+named_packages = len(names) > 0
+if not names and not testing_only:
+    names = [package.name for package in registry if package.default]
+selected = select_packages(names)
 
-# Check for list of packages to install.
-for param in sys.argv:
-    if (param == 'ADPAA'):
-        adpaa = 1
-    if (param == 'adpaa'):
-        adpaa = 1
-    if (param == 'ADTAE'):
-        adtae = 1
-    if (param == 'adtae'):
-        adtae = 1
-    if (param == 'AOSPY'):
-        aospy = 1
-    if (param == 'aospy'):
-        aospy = 1
-    if (param == 'DRILSDOWN'):
-        drilsdown = 1
-    if (param == 'drilsdown'):
-        drilsdown = 1
-    if (param == 'EUFAR'):
-        eufar = 1
-    if (param == 'eufar'):
-        eufar = 1
-    if (param == 'LROSE'):
-        lrose = 1
-    if (param == 'lrose'):
-        lrose = 1
-    if (param == 'SAMAC'):
-        samac = 1
-    if (param == 'samac'):
-        samac = 1
-    if (param == 'SIMDATA'):
-        simdata = 1
-    if (param == 'simdata'):
-        simdata = 1
-    if (param == 'SODA'):
-        soda = 1
-    if (param == 'soda'):
-        soda = 1
-    if (param == 'UIOPS'):
-        uiops = 1
-    if (param == 'uiops'):
-        uiops = 1
-    if (param == 'COYOTE'):
-        coyote = 1
-    if (param == 'coyote'):
-        coyote = 1
-    if (param == 'Coyote'):
-        coyote = 1
 # Check for list of long name options.
 for param in sys.argv:
     if (param == 'nobinary'):
         binary = 0
     if (param == 'notesting'):
         testing = 0
-
-
-# Import package with existing checking.
-print ("Importing Modules:")
-import imp
-print ("  The imp module imported.")
-
-try:
-    imp.find_module('git')
-except ImportError:
-    print ("**  WARNING:  The python 'git' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**    Fedora - sudo dnf install python3-GitPython")
-    print ("**    Ubuntu - sudo apt install python3-git")
-    pass
-else:
-    import git
-    print ("  The git module imported.")
-
-try:
-    imp.find_module('numpy')
-except ImportError:
-    print ("**  WARNING:  The python 'numpy' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**    Redhat - sudo yum install python3-numpy")
-    print ("**    Fedora - sudo dnf install python3-GitPython")
-    print ("**    Ubuntu - sudo apt install python3-git")
-    pass
-else:
-    import numpy
-    print ("  The numpy module imported.")
-
-try:
-    imp.find_module('os')
-    import os
-except ImportError:
-    print ("**  WARNING:  The python 'os' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**    Redhat - sudo yum install python-libs")
-    print ("**    Fedora - sudo dnf install python-libs")
-    pass
-else:
-    import os
-    print ("  The os module imported.")
-
-### PIP required for AOSPY. ###
-try:
-    import pip
-except ImportError:
-    print ("  The python 'pip' module does not exists.")
-    print ("  pip only required for AOSPY.")
-    pass
-else:
-    import pip
-    print ("  The pip module imported.")
-
-try:
-    imp.find_module('requests')
-    import requests
-except ImportError:
-    print ("**  WARNING:  The python 'requests' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**    Redhat - sudo yum install python3-requests")
-    print ("**    Fedora - sudo dnf install python3-requests")
-    print ("**    Ubuntu - sudo apt install python3-requests")
-    pass
-else:
-    import requests
-    print ("  The requests module imported.")
-
-try:
-    imp.find_module('svn')
-    import svn
-except ImportError:
-    print ("**  WARNING:  The python 'pysvn' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**    Redhat - sudo yum install python3-svn")
-    print ("**    Fedora - sudo dnf install python3-svn")
-    print ("**    Ubuntu - sudo apt install python3-svn")
-    pass
-else:
-    import svn
-    print ("  The svn module imported.")
-
-try:
-    imp.find_module('shutil')
-except ImportError:
-    print ("**  WARNInG:  The python 'shutil' module does not exists.")
-    pass
-else:
-    import shutil
-    print ("  The shutil module imported.")
-
-try:
-    imp.find_module('sys')
-except ImportError:
-    print ("**  WARNInG:  The python 'sys' module does not exists.")
-    pass
-else:
-    import sys 
-    print ("  The sys module imported.")
-
-try:
-    import tarfile
-except ImportError:
-    print ("**  WARNING:  The python 'tarfile' module does not exists.")
-    pass
-else:
-    import tarfile
-    print ("  The tarfile module imported.")
-
-try:
-    import urllib3
-except ImportError:
-    print ("**  WARNING:  The python 'urllib3' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**     Redhat - sudo yum install python-urllibs3")
-    print ("**     Fedora - sudo dnf install python3-urllibs3")
-    pass
-else:
-    import urllib3
-    print ("  The urllib3 module imported.")
-
-try:
-    import unittest2
-except ImportError:
-    print ("**  WARNING:  The python 'unittest2' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**      Redhat - sudo dnf install python3-unittest2")
-    print ("**      Fedora - sudo dnf install python3-unittest2")
-    print ("**      Ubuntu - sudo apt install python3-unittest2")
-    pass
-else:
-    import unittest2
-    print ("  The unittest2 module imported.")
-
-try:
-    import wget
-except ImportError:
-    print ("**  WARNING:  The python 'wget' module does not exists.")
-    print ("**    Please install (see suggestion below) and execute again.")
-    print ("**      pip install wget")
-    pass
+    if (param == 'stream'):
+        stream = 1
+    if (param == 'keeparchive'):
+        keep_archive = 1
+    if (param == 'nocheck'):
+        remote_check = 0
+
+
+# Check for the support modules needed by the selected packages.  Modules
+# are only looked up (importlib.util.find_spec), not imported; the package
+# steps import them when they run, so -h, -t and runs that do not need a
+# module do not pay for importing it.
+probe_start = time.time()
+print ("Checking Modules:")
+if testing_only:
+    check_support_modules(None)
 else:
-    import wget
-    print ("  The wget module imported.")
-
+    check_support_modules(selected)
+probe_time = time.time() - probe_start
+if testing_only:
+    print ("  Module checks took {0:.1f} ms, startup {1:.1f} ms.".format(
+        probe_time*1000, (time.time() - startup_time)*1000))
 
 # Exit if only want testing for support programs.
 if testing_only:
     exit()
 
-class Progress(git.remote.RemoteProgress):
-    def update(self, op_code, cur_count, max_count=None, message=''):
-        print ('{0}\r'.format(self._cur_line))
-
-
-print ("Cloning and Updating Repositories:")
-
-### Airborne Data Processing and Analysis (ADPAA) software package. ###
-if (adpaa):
-    # Create directories.
-    print ("  Working on Airborne Data Processing and Analysis (ADPAA) package.")
-    if (binary):
-        print ("    Downloading binary version of ADPAA.")
-        if not os.path.isdir("ADPAA"):
-            os.mkdir('ADPAA')
-        os.chdir('ADPAA')
-        if not os.path.isdir("binary_distributions"):
-            os.mkdir('binary_distributions')
-        os.chdir('binary_distributions')
-
-        url = "http://sourceforge.net/projects/adpaa/files/ADPAA.tar.gz/download"
-        file_name = "ADPAA.tar.gz"
-        wget.download(url,file_name)
-
-        # Extract distribution from compressed tar file.
-        print ("   Extracting ADPAA distribution from compressed tar file.")
-        tar = tarfile.open('ADPAA.tar.gz', "r:gz")
-        tar.extractall("..")
-        tar.close()
 
-        # Go back to base directory.
-        os.chdir('../..')
-
-    if (source):
-        if not os.path.isdir("ADPAA/src"):
-            print ("    Cloning ADPAA source code from repository.")
-            if not os.path.isdir("ADPAA"):
-                os.mkdir('ADPAA')
-            os.chdir('ADPAA')
-            client = svn.Client()
-            svn_username = os.environ.get('SVN_USERNAME')
-            sourceforge_user = os.environ.get('SOURCEFORGE_USER')
-            if svn_username is None:
-                if sourceforge_user is None:
-                    client.checkout('svn://svn.code.sf.net/p/adpaa/code/trunk/src','src')
+# Serializes output from concurrently running steps and the progress line.
+print_lock = threading.RLock()
+
+### Progress reporting. ###
+# Steps report transfer progress to one board instead of printing it.  On a
+# terminal the board keeps a single live line with one entry per running
+# transfer and the combined rate, redrawn at most every progress_refresh
+# seconds; log messages clear it first.  When stdout is not a terminal (log
+# files, CI) it prints a summary line every progress_interval seconds.
+progress_refresh  = 0.2
+progress_interval = 30
+
+class ProgressBoard:
+    def __init__(self, stream):
+        self.stream  = stream
+        self.live    = stream.isatty()
+        self.entries = {}
+        self.shown   = False
+        self.drawn   = time.time()
+        # Combined rate: bytes received since the first transfer started.
+        self.start   = None
+        self.bytes   = 0
+
+    # Set the text of the transfer called name, adding count bytes received.
+    def update(self, name, text, count=0):
+        with print_lock:
+            now = time.time()
+            self.entries[name] = text
+            if count and self.start is None:
+                self.start = now
+            self.bytes += count
+            if now - self.drawn >= (progress_refresh if self.live else progress_interval):
+                self.drawn = now
+                self.draw(now)
+
+    def draw(self, now):
+        line = " | ".join(self.entries.values())
+        if self.bytes:
+            line += " | %.1f MB/s" % (self.bytes / 1e6 / max(now - self.start, 1e-3))
+        if self.live:
+            width = shutil.get_terminal_size().columns - 3
+            self.stream.write("\r  "+line[:width]+"\x1b[K")
+            self.shown = True
+        else:
+            self.stream.write("  Progress: "+line+"\n")
+        self.stream.flush()
+
+    # Remove the transfer called name once it is over.
+    def finish(self, name):
+        with print_lock:
+            self.entries.pop(name, None)
+            if not self.entries:
+                self.clear()
+
+    # Erase the live line, so a log message can be printed in its place.
+    def clear(self):
+        with print_lock:
+            if self.shown:
+                self.stream.write("\r\x1b[K")
+                self.shown = False
+
+progress_board = ProgressBoard(sys.stdout)
+
+# Print a log message, clearing the live progress line first.
+def emit(message):
+    with print_lock:
+        progress_board.clear()
+        print (message)
+
+# GitPython progress handler that reports to the progress board through
+# report.  Created on first use so GitPython is only imported when a git
+# package is processed.
+def make_progress(report):
+    import git
+    stages = {git.remote.RemoteProgress.COUNTING:       'counting objects',
+              git.remote.RemoteProgress.COMPRESSING:    'compressing objects',
+              git.remote.RemoteProgress.RECEIVING:      'receiving objects',
+              git.remote.RemoteProgress.RESOLVING:      'resolving deltas',
+              git.remote.RemoteProgress.CHECKING_OUT:   'checking out files'}
+    class Progress(git.remote.RemoteProgress):
+        def update(self, op_code, cur_count, max_count=None, message=''):
+            stage = stages.get(op_code & self.OP_MASK, 'working')
+            if max_count:
+                report("%s %d%%" % (stage, 100*cur_count // max_count))
+            else:
+                report("%s %d" % (stage, cur_count))
+    return Progress()
+
+# One unit of work for a package (download, extract, checkout, pull, verify).
+# A step runs once every step named in depends has finished successfully.
+class Step:
+    def __init__(self, package, kind, function, depends=(), heading=None):
+        self.package  = package
+        self.kind     = kind
+        self.name     = package+':'+kind
+        self.function = function
+        self.depends  = list(depends)
+        self.heading  = heading
+        self.status   = 'pending'
+        self.error    = None
+        self.duration = 0.0
+        # Bytes received over the network and the time of named parts of
+        # the step (for example connect), filled in by count_bytes and
+        # time_phase while the step runs.
+        self.bytes    = 0
+        self.expected = None
+        self.phases   = {}
+
+# The step running in the current thread, for count_bytes and time_phase.
+step_context = threading.local()
+
+def current_step():
+    return getattr(step_context, 'step', None)
+
+# Add count received bytes to step, by default the current step, and show
+# the transfer on the progress board.
+def count_bytes(count, step=None):
+    step = step or current_step()
+    if step is None:
+        return
+    with print_lock:
+        step.bytes += count
+        if step.expected:
+            text = "%s %.1f of %.1f MB" % (step.package, step.bytes/1e6, step.expected/1e6)
+        else:
+            text = "%s %.1f MB" % (step.package, step.bytes/1e6)
+        progress_board.update(step.name, text, count)
+
+# Set the number of bytes the current step is going to receive in total.
+def expect_bytes(count):
+    step = current_step()
+    if step is not None:
+        step.expected = count
+
+# Add seconds to the named part of the current step.
+def time_phase(name, seconds):
+    step = current_step()
+    if step is not None:
+        step.phases[name] = step.phases.get(name, 0.0) + seconds
+
+# Run one step, recording its status, error and duration.  The step gets
+# a log function and a progress function, which shows its argument as the
+# step's entry on the progress board.
+def run_step(step, buffered):
+    messages = []
+    if buffered:
+        log = messages.append
+    else:
+        log = emit
+    def progress(text):
+        progress_board.update(step.name, step.package+" "+text)
+    if step.heading:
+        log(step.heading)
+    start = time.time()
+    step_context.step = step
+    try:
+        step.function(log, progress)
+    except Exception as exc:
+        step.status = 'failed'
+        step.error = exc
+        log("**  ERROR:  "+step.name+" failed: "+str(exc).strip())
+    else:
+        step.status = 'done'
+    finally:
+        step_context.step = None
+        progress_board.finish(step.name)
+    step.duration = time.time() - start
+    if buffered:
+        # Print each step's messages as one block so output stays readable.
+        with print_lock:
+            progress_board.clear()
+            for message in messages:
+                print (message)
+            sys.stdout.flush()
+    return step
+
+# Run the steps on a pool of jobs workers, starting each step as soon as its
+# dependencies are done.  Steps whose dependencies failed are skipped;
+# dependencies on steps that are not part of this run are ignored.
+def run_steps(steps, jobs):
+    by_name = {}
+    for step in steps:
+        by_name[step.name] = step
+    for step in steps:
+        step.depends = [name for name in step.depends if name in by_name]
+    pending = list(steps)
+    running = set()
+    pool = None
+    if jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    while pending or running:
+        progressed = False
+        for step in list(pending):
+            states = [by_name[name].status for name in step.depends]
+            if 'failed' in states or 'skipped' in states:
+                step.status = 'skipped'
+                pending.remove(step)
+                progressed = True
+            elif all(state == 'done' for state in states):
+                pending.remove(step)
+                step.status = 'running'
+                if pool is None:
+                    run_step(step, False)
                 else:
-                    client.checkout('svn+ssh://'+sourceforge_user+'@svn.code.sf.net/p/adpaa/code/trunk/src','src')
+                    running.add(pool.submit(run_step, step, True))
+                progressed = True
+        if running:
+            finished, running = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+        elif not progressed:
+            # Nothing can start, the remaining steps depend on each other.
+            break
+    if pool is not None:
+        pool.shutdown()
+    for step in pending:
+        step.status = 'skipped'
+        step.error = RuntimeError('circular step dependency')
+    return steps
+
+# Length of the longest chain of dependent steps, which bounds the run time.
+def critical_path(steps):
+    by_name = {}
+    for step in steps:
+        by_name[step.name] = step
+    finish = {}
+    def finish_time(step):
+        if step.name not in finish:
+            finish[step.name] = 0.0
+            finish[step.name] = step.duration + max(
+                [finish_time(by_name[name]) for name in step.depends] + [0.0])
+        return finish[step.name]
+    return max([finish_time(step) for step in steps] + [0.0])
+
+# Print the per-step results.
+def print_step_summary(steps, elapsed):
+    if not steps:
+        return
+    print ("Step Summary:")
+    for step in steps:
+        line = "  "+step.name.ljust(20)+" "
+        if step.status == 'done':
+            line += "OK      "+"{0:7.1f}s".format(step.duration)
+        elif step.status == 'skipped':
+            line += "SKIPPED (dependency failed)"
+        else:
+            line += "FAILED  "+"{0:7.1f}s".format(step.duration)
+            line += " ("+str(step.error).strip().splitlines()[0]+")"
+        print (line)
+    print ("  Run time {0:.1f}s, critical path {1:.1f}s, all steps {2:.1f}s.".format(
+        elapsed, critical_path(steps), sum(step.duration for step in steps)))
+
+# Throughput in MB/s of count bytes in seconds, None without a transfer.
+def throughput(count, seconds):
+    if not count or seconds <= 0:
+        return None
+    return count / seconds / 1e6
+
+# Print one row per package with the time of each phase (step kind) and
+# the bytes received, so slow mirrors and slow extractions stand out.
+def print_phase_summary(steps, probe):
+    if not steps:
+        return
+    kinds = []
+    for step in steps:
+        if step.kind not in kinds:
+            kinds.append(step.kind)
+    print ("Phase Summary (seconds):")
+    print ("  "+"package".ljust(12)+"".join(kind.rjust(10) for kind in kinds)+"MB".rjust(10)+"MB/s".rjust(8))
+    packages = []
+    for step in steps:
+        if step.package not in packages:
+            packages.append(step.package)
+    for package in packages:
+        own = dict((step.kind, step) for step in steps if step.package == package)
+        line = "  "+package.ljust(12)
+        for kind in kinds:
+            line += ("{0:10.2f}".format(own[kind].duration) if kind in own else "-".rjust(10))
+        count = sum(step.bytes for step in own.values())
+        rate = throughput(count, sum(step.duration for step in own.values() if step.bytes))
+        line += "{0:10.1f}".format(count/1e6)
+        line += ("{0:8.1f}".format(rate) if rate is not None else "-".rjust(8))
+        print (line)
+    print ("  Module checks {0:.2f}s.".format(probe))
+
+# Write the run report: each step's status, time, bytes, throughput and
+# timed parts, grouped by package, as JSON to path.
+def write_report(path, steps, elapsed, probe):
+    import socket
+    report = {'host': socket.gethostname(),
+              'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(startup_time)),
+              'elapsed': round(elapsed, 3),
+              'critical_path': round(critical_path(steps), 3),
+              'probe': round(probe, 3),
+              'jobs': jobs,
+              'bytes': sum(step.bytes for step in steps),
+              'packages': {}}
+    for step in steps:
+        package = report['packages'].setdefault(step.package, {'bytes': 0, 'seconds': 0.0, 'phases': {}})
+        rate = throughput(step.bytes, step.duration)
+        package['phases'][step.kind] = {
+            'status': step.status,
+            'seconds': round(step.duration, 3),
+            'bytes': step.bytes,
+            'mb_per_second': round(rate, 3) if rate is not None else None,
+            'parts': dict((name, round(seconds, 3)) for name, seconds in step.phases.items())}
+        package['bytes'] += step.bytes
+        package['seconds'] = round(package['seconds'] + step.duration, 3)
+    write_json(path, report)
+
+### Shared HTTP session. ###
+# All artifact requests go through one requests session, so connections are
+# kept alive and reused across files and steps.  Every request has a
+# timeout of http_timeout (connect, read) seconds; failed connections and
+# 429 and 5xx answers are retried http_retries times with exponential
+# backoff; and at most http_host_limit requests (or --segments, if larger)
+# talk to one host at a time.
+http_timeout    = (30, 300)
+http_retries    = 4
+http_host_limit = 4
+http_lock       = threading.Lock()
+http_session    = None
+http_slots      = {}
+
+def get_http_session():
+    global http_session
+    with http_lock:
+        if http_session is None:
+            import requests
+            from urllib3.util.retry import Retry
+            retry = Retry(total=http_retries, backoff_factor=1, raise_on_status=False,
+                          status_forcelist=[429, 500, 502, 503, 504])
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=16, pool_maxsize=max(http_host_limit, download_segments),
+                max_retries=retry)
+            http_session = requests.Session()
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+        return http_session
+
+# Semaphore bounding the concurrent requests to the host of url.  Callers
+# hold it until they have closed the response.
+def host_slot(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with http_lock:
+        if host not in http_slots:
+            http_slots[host] = threading.BoundedSemaphore(max(http_host_limit, download_segments))
+        return http_slots[host]
+
+# Start a streaming GET of url through the shared session, adding the time
+# to the response headers to the current step's connect phase.
+def http_get(url, headers=None):
+    start = time.time()
+    response = get_http_session().get(url, headers=headers, stream=True, timeout=http_timeout)
+    time_phase('connect', time.time() - start)
+    return response
+
+# Raised when a transfer breaks off after its answer arrived (the
+# connection drops or stalls, or the body is short), the one failure
+# resumed_download retries; the session already retried the others.
+class BrokenTransfer(IOError):
+    pass
+
+# The body of response in chunks, raising BrokenTransfer when the
+# connection drops or stalls part way.
+def receive_chunks(response, size=64*1024):
+    import requests
+    try:
+        for chunk in response.iter_content(chunk_size=size):
+            yield chunk
+    except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as exc:
+        raise BrokenTransfer(str(exc))
+
+### HTTP download cache. ###
+# Downloaded artifacts are kept in the cache directory together with their ETag
+# and Last-Modified values, so later runs send conditional requests and skip
+# the transfer when the server answers 304 Not Modified.  Least recently used
+# files are removed once the cache grows past cache_size_limit bytes; files
+# named in cache_pinned are never removed.
+cache_size_limit = int(os.environ.get('COPAS_CACHE_MB', '4096'))*1024*1024
+cache_pinned     = ['ADPAA.tar.gz']
+cache_lock       = threading.Lock()
+
+# Smallest byte range worth a connection of its own in segmented downloads.
+segment_minimum  = 1024*1024
+
+# Most file content held in memory waiting for extraction writer threads.
+extract_buffer   = 64*1024*1024
+
+def cache_index_path():
+    return os.path.join(cache_directory, 'index.json')
+
+def load_cache_index():
+    try:
+        with open(cache_index_path()) as index_file:
+            return json.load(index_file)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache_index(index):
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    temp_name = cache_index_path()+'.tmp'
+    with open(temp_name, 'w') as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    os.replace(temp_name, cache_index_path())
+
+# Remove least recently used, unpinned files until the cache fits its limit.
+# The entry for url keep is never removed.
+def evict_cache(index, log, keep=None):
+    total = sum(entry['size'] for entry in index.values())
+    for url, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+        if total <= cache_size_limit:
+            break
+        if entry['pinned'] or url == keep:
+            continue
+        path = os.path.join(cache_directory, entry['file'])
+        if os.path.exists(path):
+            os.remove(path)
+        total -= entry['size']
+        del index[url]
+        log("    Removed "+entry['file']+" from the download cache.")
+
+# Download url to path through path+'.part'.  An interrupted download is
+# resumed with an HTTP Range request by the next call, also from a later
+# CoPAS run; If-Range makes the server send the whole file instead when it
+# changed since the partial download started.  The file is hashed as it
+# arrives.  Returns the response and the SHA-256 of the file, or None and
+# None when the server answered 304 Not Modified to the conditional headers.
+def http_download(url, path, log, headers=None):
+    part_name = path+'.part'
+    info_name = part_name+'.json'
+    request_headers = dict(headers or {})
+    offset = 0
+    if os.path.exists(part_name) and os.path.exists(info_name):
+        with open(info_name) as info_file:
+            info = json.load(info_file)
+        validator = info.get('etag') or info.get('last_modified')
+        if validator and info.get('url') == url and 'segments' not in info:
+            offset = os.path.getsize(part_name)
+        if offset > 0:
+            request_headers = {'Range': 'bytes='+str(offset)+'-', 'If-Range': validator}
+    with host_slot(url):
+        response = http_get(url, request_headers)
+        try:
+            restart = response.status_code == 416 and offset > 0
+            if response.status_code == 304 and 'Range' not in request_headers:
+                return None, None
+            if not restart:
+                digest = http_receive(url, response, path, offset, log)
+        finally:
+            response.close()
+    if restart:
+        # The partial file does not fit the server's file, start over.
+        os.remove(info_name)
+        return http_download(url, path, log, headers)
+    return response, digest
+
+# Write the body of the response for url to path through path+'.part',
+# appending when it is the requested continuation at offset of a partial
+# download.  Returns the SHA-256 of the whole file.
+def http_receive(url, response, path, offset, log):
+    part_name = path+'.part'
+    info_name = part_name+'.json'
+    digest = hashlib.sha256()
+    response.raise_for_status()
+    content_range = response.headers.get('Content-Range', '')
+    length = response.headers.get('Content-Length', '')
+    if response.status_code == 206 and content_range.startswith('bytes '+str(offset)+'-'):
+        log("    Resuming "+os.path.basename(path)+" download at byte "+str(offset)+".")
+        mode = 'ab'
+        if length.isdigit():
+            expect_bytes(int(length))
+        # The part from the earlier attempt is on disk, hash it first.
+        with open(part_name, 'rb') as part_file:
+            for data in iter(lambda: part_file.read(1024*1024), b''):
+                digest.update(data)
+    else:
+        if offset > 0:
+            log("    "+os.path.basename(path)+" changed on server, restarting download.")
+        mode = 'wb'
+        if length.isdigit():
+            expect_bytes(int(length))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(info_name, 'w') as info_file:
+            json.dump({'url': url,
+                       'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')},
+                      info_file)
+    received = 0
+    with open(part_name, mode) as output:
+        # Small chunks so little is lost when the connection drops.
+        for chunk in receive_chunks(response):
+            output.write(chunk)
+            digest.update(chunk)
+            count_bytes(len(chunk))
+            received += len(chunk)
+    if length.isdigit() and 'Content-Encoding' not in response.headers and received < int(length):
+        raise BrokenTransfer("Short body, "+str(received)+" of "+length+" bytes.")
+    os.replace(part_name, path)
+    os.remove(info_name)
+    return digest.hexdigest()
+
+# Download url to path over up to segments connections at once.  Each
+# connection fetches one byte range and writes it in place (os.pwrite) into
+# a preallocated path+'.part'; finished ranges are recorded in the
+# .part.json sidecar so a later run only fetches the missing ones.  Falls
+# back to a single stream (http_download) when the server ignores Range.
+# Finished ranges are hashed in file order while later ones still download,
+# reading them back from the page cache.  Returns like http_download.
+def segmented_download(url, path, segments, log, headers=None):
+    probe_headers = dict(headers or {})
+    probe_headers['Range'] = 'bytes=0-0'
+    with host_slot(url):
+        probe = http_get(url, probe_headers)
+        probe.close()
+    if headers and probe.status_code == 304:
+        return None, None
+    probe.raise_for_status()
+    content_range = probe.headers.get('Content-Range', '')
+    total = content_range.rpartition('/')[2]
+    if probe.status_code != 206 or not total.isdigit() or int(total) < 2*segment_minimum:
+        # No range support (or too small to be worth it), use one stream.
+        return http_download(url, path, log, headers)
+    total = int(total)
+    etag = probe.headers.get('ETag')
+    last_modified = probe.headers.get('Last-Modified')
+    validator = etag or last_modified
+    count = min(segments, total // segment_minimum)
+    size = -(-total // count)
+    ranges = [[start, min(start+size, total)-1] for start in range(0, total, size)]
+
+    part_name = path+'.part'
+    info_name = part_name+'.json'
+    info = {}
+    if os.path.exists(part_name) and os.path.exists(info_name):
+        with open(info_name) as info_file:
+            info = json.load(info_file)
+    if (info.get('url') != url or info.get('validator') != validator or
+            info.get('size') != total or info.get('segments') != ranges or validator is None):
+        info = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                'validator': validator, 'size': total, 'segments': ranges, 'done': []}
+        if os.path.exists(part_name):
+            os.remove(part_name)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    descriptor = os.open(part_name, os.O_RDWR | os.O_CREAT, 0o644)
+    info_lock = threading.Lock()
+    step = current_step()
+    digest = hashlib.sha256()
+    hashed = [0]
+    expect_bytes(sum(end+1-start for start, end in ranges
+                     if [start, end] not in info['done']))
+    try:
+        if os.fstat(descriptor).st_size != total:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(descriptor, 0, total)
             else:
-                client.checkout('svn+ssh://'+svn_username+'@svn.code.sf.net/p/adpaa/code/trunk/src','src')
-            os.chdir('..')
-            print ("    Finished cloning ADPAA source code from repository.")
+                os.ftruncate(descriptor, total)
+        with open(info_name, 'w') as info_file:
+            json.dump(info, info_file)
+        missing = [segment for segment in ranges if segment not in info['done']]
+        if len(missing) < len(ranges):
+            log("    Resuming "+os.path.basename(path)+" download, "+
+                str(len(missing))+" of "+str(len(ranges))+" segments left.")
         else:
-            # Updating existing ADPAA repository.
-            print ("    Updating existing ADPAA source code from repository.")
-            os.chdir('ADPAA')
-            client = svn.Client()
-            client.update('src')
-            os.chdir('..')
-            print ("    Finished updating ADPAA source code from repository.")
-    if (testing):
-        print ("    Tesing for non-installed ADPAA support packages.")
+            log("    Downloading "+os.path.basename(path)+" in "+str(len(ranges))+" segments.")
+
+        # Hash the finished ranges that follow the hashed part of the file.
+        # Called with info_lock held.
+        def advance_hash():
+            while hashed[0] < len(ranges) and ranges[hashed[0]] in info['done']:
+                start, end = ranges[hashed[0]]
+                while start <= end:
+                    data = os.pread(descriptor, min(1024*1024, end+1-start), start)
+                    if not data:
+                        raise IOError("Short read of "+part_name+".")
+                    digest.update(data)
+                    start += len(data)
+                hashed[0] += 1
+
+        def fetch(segment):
+            start, end = segment
+            segment_headers = {'Range': 'bytes='+str(start)+'-'+str(end)}
+            if validator:
+                segment_headers['If-Range'] = validator
+            with host_slot(url):
+                fetch_range(segment_headers, start, end)
+            with info_lock:
+                info['done'].append(segment)
+                with open(info_name, 'w') as info_file:
+                    json.dump(info, info_file)
+                advance_hash()
+
+        def fetch_range(segment_headers, start, end):
+            response = http_get(url, segment_headers)
+            try:
+                response.raise_for_status()
+                if (response.status_code != 206 or not response.headers.get(
+                        'Content-Range', '').startswith('bytes '+str(start)+'-'+str(end)+'/')):
+                    raise IOError(os.path.basename(path)+" changed on server during download.")
+                offset = start
+                for chunk in receive_chunks(response):
+                    os.pwrite(descriptor, chunk, offset)
+                    offset += len(chunk)
+                    count_bytes(len(chunk), step)
+                if offset != end+1:
+                    raise BrokenTransfer("Incomplete segment "+str(start)+"-"+str(end)+".")
+            finally:
+                response.close()
+
+        with info_lock:
+            advance_hash()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            for future in [pool.submit(fetch, segment) for segment in missing]:
+                future.result()
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+    os.replace(part_name, path)
+    os.remove(info_name)
+    return probe, digest.hexdigest()
+
+# Download url to path (segmented with --segments), retrying a transfer
+# that breaks off after its answer arrived (BrokenTransfer) http_retries
+# times with exponential backoff; each retry resumes from the partial file.
+# Connection failures and HTTP error answers are not retried here, the
+# session already retried them.  Returns like http_download.
+def resumed_download(url, path, log, headers=None):
+    for attempt in range(http_retries+1):
         try:
-            import csv 
-        except ImportError:
-            print ("    Required python 'csv' module is not installed.")
-            quit()
+            if download_segments > 1:
+                return segmented_download(url, path, download_segments, log, headers)
+            return http_download(url, path, log, headers)
+        except BrokenTransfer as exc:
+            if attempt == http_retries:
+                raise
+            delay = 2**attempt
+            log("    Download of "+os.path.basename(path)+" broke off ("+str(exc).strip()+
+                "), retrying in "+str(delay)+" s.")
+            time.sleep(delay)
+
+# Download url into the cache as name, using a conditional request when a
+# cached copy exists.  Returns the cache entry; entry['changed'] is False
+# when the server reported the cached copy as current.
+def cached_download(url, name, log):
+    with cache_lock:
+        entry = load_cache_index().get(url)
+    path = os.path.join(cache_directory, name)
+    headers = {}
+    if entry is not None and os.path.exists(path):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    response, digest = resumed_download(url, path, log, headers)
+    if response is None:
+        log("    "+name+" not modified on server, using cached copy.")
+        entry['changed'] = False
+        if not entry.get('sha256'):
+            # Cached before downloads were hashed, hash it this once.
+            entry['sha256'] = file_digest(path)
+    else:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        entry = {'file': name,
+                 'etag': etag,
+                 'last_modified': last_modified,
+                 'size': os.path.getsize(path),
+                 'validator': etag or last_modified or str(time.time()),
+                 'sha256': digest,
+                 'changed': True}
+    entry['pinned'] = name in cache_pinned
+    entry['last_used'] = time.time()
+    entry['path'] = path
+    with cache_lock:
+        index = load_cache_index()
+        index[url] = dict((key, entry[key]) for key in entry if key not in ('changed', 'path'))
+        evict_cache(index, log, url)
+        save_cache_index(index)
+    return entry
+
+# Cache entry of the archive of package as --fetch-only left it, without
+# asking the server; raises IOError when it is not cached.
+def cached_artifact(package):
+    with cache_lock:
+        entry = load_cache_index().get(package.url)
+    path = os.path.join(cache_directory, package.artifact)
+    if entry is None or not os.path.exists(path):
+        raise IOError(package.artifact+" is not in the download cache, run CoPAS.py --fetch-only first.")
+    entry['path'] = path
+    entry['changed'] = True
+    return entry
+
+# Record in the cache index whether the cached download of url matched its
+# checksum.
+def mark_verified(url, verified):
+    with cache_lock:
+        index = load_cache_index()
+        if url in index:
+            index[url]['verified'] = verified
+            save_cache_index(index)
+
+# Remove the cached download of url, for example after it failed its
+# checksum, so the next run downloads it again.
+def discard_cached(url):
+    with cache_lock:
+        index = load_cache_index()
+        entry = index.pop(url, None)
+        if entry is not None:
+            path = os.path.join(cache_directory, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+            save_cache_index(index)
+
+# SHA-256 of the file at path.
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for data in iter(lambda: input_file.read(1024*1024), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+# Hard link (or copy, across file systems) a cached file to destination.
+def install_cached_file(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+# Whether destination is still the installed copy of the cached file
+# source: the same file, or a copy with its size and mtime.  A cache file
+# replaced by a later download (another install root, a prefetch) is a new
+# file, so the old link or copy does not match it.
+def installed_cached_file(source, destination):
+    try:
+        if os.path.samefile(source, destination):
+            return True
+        source_status = os.stat(source)
+        status = os.stat(destination)
+    except OSError:
+        return False
+    return (status.st_size == source_status.st_size and
+            status.st_mtime_ns == source_status.st_mtime_ns)
+
+# File-like wrapper that hashes and counts everything read through it and
+# optionally writes a copy, so one pass over a download can extract, hash
+# and keep it.
+class HashingReader:
+    def __init__(self, stream, copy=None):
+        self.stream = stream
+        self.copy   = copy
+        self.digest = hashlib.sha256()
+        self.size   = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        count_bytes(len(data))
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    # Read whatever follows the tar end-of-archive blocks so the hash and
+    # the kept copy cover the whole file.
+    def drain(self):
+        while self.read(64*1024):
+            pass
+
+# Read and write the small JSON files CoPAS keeps: extraction markers,
+# manifests, the state file, reports and bundle descriptions.  A missing or
+# unreadable file reads as an empty dictionary.
+def read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return {}
+
+def write_json(path, values):
+    with open(path, 'w') as json_file:
+        json.dump(values, json_file, indent=1, sort_keys=True)
+
+# Write one extracted file atomically, returning its SHA-256.  Permissions
+# and mtimes are applied by the caller once all files are written.
+def write_extracted_file(target, data):
+    temp_name = target+'.copas-tmp'
+    with open(temp_name, 'wb') as output:
+        output.write(data)
+    os.replace(temp_name, target)
+    return hashlib.sha256(data).hexdigest()
+
+# Extract the members of an open tar file into destination, writing only
+# files that are new or changed since the last extraction.  The manifest
+# file records path, size, mtime and SHA-256 of every extracted file (and
+# the links); files and links listed there that are no longer in the
+# archive are removed.  Works with both random access and stream ("r|gz")
+# tar files.
+#
+# The archive is decompressed once, here; with workers > 1 the file
+# contents are handed to a pool of writer threads, holding at most
+# extract_buffer bytes in memory.  Directories are created in archive order
+# before their files are queued, and permissions and mtimes are set after
+# all files are written.
+def incremental_extract(tar, destination, manifest, log, workers=None):
+    if workers is None:
+        workers = extract_workers
+    old_files = read_json(manifest).get('files', {})
+    new_files = {}
+    written_files = []
+    directories   = []
+    written_bytes = 0
+    kept = 0
+    start = time.time()
+    destination_root = os.path.realpath(destination)
+    budget = threading.Condition()
+    buffered = [0]
+    pool = None
+    if workers > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def release(size):
+        with budget:
+            buffered[0] -= size
+            budget.notify_all()
+
+    def write(name, target, data):
         try:
-            import numpy 
-        except ImportError:
-            print ("    Required python 'numpy' module is not installed.")
-            quit()
+            new_files[name][2] = write_extracted_file(target, data)
+        finally:
+            release(len(data))
+
+    futures = []
+    try:
+        for member in tar:
+            # The member's own path, only its directory resolved, so an
+            # existing link at that path is replaced, not followed.
+            joined = os.path.normpath(os.path.join(destination, member.name))
+            target = os.path.join(os.path.realpath(os.path.dirname(joined)), os.path.basename(joined))
+            if not (target == destination_root or target.startswith(destination_root+os.sep)):
+                log("    Skipping "+member.name+", it is outside the extraction directory.")
+                continue
+            name = os.path.normpath(member.name)
+            if not member.isfile():
+                if member.isdir():
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    directories.append((target, member.mode, member.mtime))
+                else:
+                    # Links and special files.  A hard link needs its
+                    # target written, and tarfile falls back to reading the
+                    # target from the archive (impossible when streaming)
+                    # when the link path already exists.
+                    for future in futures:
+                        future.result()
+                    if os.path.islink(target) or (os.path.lexists(target) and not os.path.isdir(target)):
+                        os.remove(target)
+                    tar.extract(member, destination)
+                    new_files[name] = [member.size, member.mtime, None]
+                continue
+            previous = old_files.get(name)
+            if previous is not None and previous[0] == member.size and previous[1] == member.mtime:
+                try:
+                    status = os.stat(target)
+                except OSError:
+                    status = None
+                if (status is not None and status.st_size == member.size and
+                        int(status.st_mtime) == int(member.mtime)):
+                    new_files[name] = previous
+                    kept += 1
+                    continue
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Wait for room in the write buffer; a member larger than the
+            # whole buffer waits until the buffer is empty.
+            with budget:
+                while buffered[0] > 0 and buffered[0] + member.size > extract_buffer:
+                    budget.wait()
+                buffered[0] += member.size
+            data = tar.extractfile(member).read()
+            new_files[name] = [member.size, member.mtime, None]
+            written_files.append((target, member.mode, member.mtime))
+            written_bytes += len(data)
+            if pool is None:
+                write(name, target, data)
+            else:
+                futures.append(pool.submit(write, name, target, data))
+        for future in futures:
+            future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    for target, mode, mtime in written_files:
+        os.chmod(target, mode & 0o7777)
+        os.utime(target, (mtime, mtime))
+    removed = 0
+    for name in sorted(set(old_files) - set(new_files), reverse=True):
+        path = os.path.join(destination, name)
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+            removed += 1
+        # Remove directories left empty by the removed files.
+        directory = os.path.dirname(path)
+        while directory and os.path.realpath(directory) != destination_root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+    # Directory modes and times last, deepest first: writing the files (and
+    # removing old ones) changes the times, and a read-only directory
+    # could not take its files.
+    for target, mode, mtime in sorted(directories, reverse=True):
+        os.chmod(target, mode & 0o7777)
+        os.utime(target, (mtime, mtime))
+    write_json(manifest, {'files': new_files})
+    elapsed = max(time.time() - start, 1e-6)
+    log("    Wrote "+str(len(written_files))+" new or changed files, kept "+str(kept)+
+        " unchanged, removed "+str(removed)+".")
+    log("    Extraction: {0:.0f} files/s, {1:.1f} MB/s with {2} writer(s).".format(
+        len(written_files)/elapsed, written_bytes/elapsed/1e6, workers))
+
+# Download url and extract the tar members into destination (incrementally,
+# see incremental_extract) as the bytes arrive, hashing the archive in the
+# same pass.  The archive is written to the download cache as name only
+# when keep is set.  The previous marker
+# values make the request conditional; returns the new marker values, or
+# None when the server answered 304 Not Modified.
+def stream_extract(url, name, destination, manifest, previous, keep, log):
+    headers = {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+    with host_slot(url):
+        response = http_get(url, headers)
         try:
-            import math
-        except ImportError:
-            print ("    Required python 'math' module is not installed.")
-            quit()
+            if headers and response.status_code == 304:
+                return None
+            return stream_receive(response, url, name, destination, manifest, keep, log)
+        finally:
+            response.close()
+
+# Extract the archive in response into destination while it downloads, as
+# stream_extract.
+def stream_receive(response, url, name, destination, manifest, keep, log):
+    response.raise_for_status()
+    response.raw.decode_content = False
+    if response.headers.get('Content-Length', '').isdigit():
+        expect_bytes(int(response.headers['Content-Length']))
+    copy = None
+    path = os.path.join(cache_directory, name)
+    if keep:
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        copy = open(path+'.tmp', 'wb')
+    reader = HashingReader(response.raw, copy)
+    try:
+        tar = tarfile.open(fileobj=reader, mode="r|gz")
+        incremental_extract(tar, destination, manifest, log)
+        tar.close()
+        reader.drain()
+    finally:
+        if copy is not None:
+            copy.close()
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    values = {'etag': etag,
+              'last_modified': last_modified,
+              'validator': etag or last_modified or str(time.time()),
+              'sha256': reader.digest.hexdigest(),
+              'size': reader.size}
+    if keep:
+        os.replace(path+'.tmp', path)
+        with cache_lock:
+            index = load_cache_index()
+            index[url] = {'file': name,
+                          'etag': etag,
+                          'last_modified': last_modified,
+                          'size': reader.size,
+                          'validator': values['validator'],
+                          'sha256': values['sha256'],
+                          'pinned': name in cache_pinned,
+                          'last_used': time.time()}
+            evict_cache(index, log, url)
+            save_cache_index(index)
+    return values
+
+# Download results shared between steps, keyed by package name.
+artifacts = {}
+
+# Paths of a package's downloaded archive and of its extraction marker and
+# manifest, all kept in the package's binary_distributions directory.
+def archive_paths(package):
+    distributions = os.path.join(package.directory, 'binary_distributions')
+    return (os.path.join(distributions, package.artifact),
+            os.path.join(distributions, '.'+package.artifact+'.extracted'),
+            os.path.join(distributions, '.'+package.artifact+'.manifest'))
+
+# SHA-256 the archive of package must have: pinned (Package sha256 or
+# COPAS_SHA256_<NAME>) or published at its checksum_url in sha256sum format.
+# None when there is neither.
+def expected_digest(package):
+    if package.sha256:
+        return package.sha256.lower()
+    if package.checksum_url is None:
+        return None
+    with host_slot(package.checksum_url):
+        response = http_get(package.checksum_url)
         try:
-            import sys
+            response.raise_for_status()
+            text = response.text
+        finally:
+            response.close()
+    for line in text.splitlines():
+        fields = line.split()
+        if fields and len(fields[0]) == 64 and (
+                len(fields) == 1 or fields[-1].lstrip('*') == package.artifact):
+            return fields[0].lower()
+    raise IOError("No checksum for "+package.artifact+" in "+package.checksum_url+".")
+
+# Check the SHA-256 computed while the archive of package downloaded against
+# the expected one.  Returns whether it was verified; raises IOError when
+# it does not match.
+def verify_digest(package, digest, log):
+    expected = expected_digest(package)
+    if expected is None:
+        log("    "+package.artifact+" sha256 "+str(digest)+" (no checksum published).")
+        return False
+    if digest != expected:
+        raise IOError(package.artifact+" is corrupt, sha256 "+str(digest)+" instead of "+expected+".")
+    log("    "+package.artifact+" sha256 verified.")
+    return True
+
+# Steps for packages distributed as an archive over HTTP: download (through
+# the download cache), check and extract, or one streaming extract step.
+def http_steps(packages):
+    steps = []
+    for package in packages:
+        archive, marker, manifest = archive_paths(package)
+        def download(log, progress, package=package, archive=archive):
+            if not os.path.isdir(os.path.dirname(archive)):
+                os.makedirs(os.path.dirname(archive))
+            if package.bundle is not None:
+                log("    Using "+package.artifact+" from the offline bundle.")
+                entry = bundled_artifact(package)
+            elif phase == 'apply':
+                log("    Using "+package.artifact+" from the download cache.")
+                entry = cached_artifact(package)
+            else:
+                log("    Downloading binary version of "+package.name+".")
+                entry = cached_download(package.url, package.artifact, log)
+            # The download was hashed as it arrived, or the hash was kept
+            # in the cache index, so checking it reads nothing again.  With
+            # --apply a published checksum is not fetched again, --fetch-only
+            # checked it and recorded the result in the cache index.
+            try:
+                if phase == 'apply' and not package.sha256:
+                    entry['verified'] = entry.get('verified', False)
+                else:
+                    entry['verified'] = verify_digest(package, entry.get('sha256'), log)
+            except IOError:
+                if package.bundle is None:
+                    discard_cached(package.url)
+                raise
+            # The validator and sha256 of entry, recorded after extraction,
+            # are those of the cached file; install it whenever the archive
+            # here is not that file, even when the server answered 304.
+            if not installed_cached_file(entry['path'], archive):
+                install_cached_file(entry['path'], archive)
+            artifacts[package.name] = entry
+
+        def extract(log, progress, package=package, archive=archive,
+                    marker=marker, manifest=manifest):
+            # Skip extraction when this version was already extracted here.
+            entry = artifacts[package.name]
+            if read_json(marker).get('validator') == entry['validator']:
+                log("    "+package.name+" distribution unchanged, skipping extraction.")
+                return
+            # Extract distribution from compressed tar file.
+            log("   Extracting "+package.name+" distribution from compressed tar file.")
+            tar = tarfile.open(archive, "r:gz")
+            incremental_extract(tar, package.directory, manifest, log)
+            tar.close()
+            write_json(marker, {'etag': entry.get('etag'),
+                                          'last_modified': entry.get('last_modified'),
+                                          'validator': entry['validator'],
+                                          'sha256': entry.get('sha256'),
+                                          'verified': entry['verified']})
+
+        # Download and extract in one pass, used with the stream option.  The
+        # archive can only be checked once it is extracted, so this is only
+        # used when there is no checksum to check; packages with a pinned or
+        # published checksum are downloaded, checked and then extracted.
+        def stream_step(log, progress, package=package, archive=archive,
+                        marker=marker, manifest=manifest):
+            log("    Downloading and extracting binary version of "+package.name+".")
+            if not os.path.isdir(os.path.dirname(archive)):
+                os.makedirs(os.path.dirname(archive))
+            values = stream_extract(package.url, package.artifact, package.directory,
+                                    manifest, read_json(marker), keep_archive, log)
+            if values is None:
+                log("    "+package.name+" distribution unchanged, skipping extraction.")
+                return
+            values['verified'] = verify_digest(package, values['sha256'], log)
+            if keep_archive:
+                install_cached_file(os.path.join(cache_directory, package.artifact), archive)
+            write_json(marker, values)
+
+        if stream and phase != 'apply' and not (package.sha256 or package.checksum_url):
+            steps.append(Step(package.name, 'extract', stream_step))
+        else:
+            steps.append(Step(package.name, 'download', download))
+            steps.append(Step(package.name, 'extract', extract, [package.name+':download']))
+    return steps
+
+# Whether the svn repository of package has commits newer than the checkout,
+# comparing the last changed revision of the URL with the working copy
+# revision.  Any failure (no svn command line client, no network) counts as
+# changed, so the update step runs and reports the problem.
+def svn_changed(package, checkout_directory):
+    if not remote_check:
+        return True
+    try:
+        remote = subprocess.check_output(['svn', 'info', '--show-item', 'last-changed-revision',
+                                          package.source_url], stderr=subprocess.DEVNULL)
+        local = subprocess.check_output(['svn', 'info', '--show-item', 'revision',
+                                         checkout_directory], stderr=subprocess.DEVNULL)
+        return int(remote) > int(local)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return True
+
+# Steps for svn source checkouts (-s and -S).  A source checkout sits next
+# to the extracted binary distribution, so it runs after the extraction.
+def svn_steps(packages):
+    steps = []
+    for package in packages:
+        checkout_directory = os.path.join(package.directory, 'src')
+        if not os.path.isdir(checkout_directory):
+            def checkout(log, progress, package=package, checkout_directory=checkout_directory):
+                log("    Cloning "+package.name+" source code from repository.")
+                if not os.path.isdir(package.directory):
+                    os.mkdir(package.directory)
+                if package.bundle_source is not None:
+                    # An svn export from an offline bundle, not a working copy.
+                    shutil.copytree(package.bundle_source, checkout_directory)
+                else:
+                    subprocess.check_call(['svn', 'checkout', '--quiet',
+                                           package.source_url, checkout_directory])
+                log("    Finished cloning "+package.name+" source code from repository.")
+            steps.append(Step(package.name, 'checkout', checkout, [package.name+':extract']))
+        elif package.bundle_source is None and not svn_changed(package, checkout_directory):
+            def current(log, progress, package=package):
+                log("    "+package.name+" source code is already up to date, not updating.")
+            steps.append(Step(package.name, 'pull', current, [package.name+':extract']))
+        else:
+            def update(log, progress, package=package, checkout_directory=checkout_directory):
+                # Updating existing repository.
+                log("    Updating existing "+package.name+" source code from repository.")
+                if package.bundle_source is not None:
+                    log("    The offline bundle has no svn history, keeping the existing checkout.")
+                    return
+                subprocess.check_call(['svn', 'update', '--quiet', checkout_directory])
+                log("    Finished updating "+package.name+" source code from repository.")
+            steps.append(Step(package.name, 'pull', update, [package.name+':extract']))
+    return steps
+
+### Shared git mirrors. ###
+# When COPAS_MIRRORS names a directory (for example on a group file server),
+# each upstream repository is kept there once as a bare mirror.  Clones in
+# every install root borrow its objects (git clone --shared, which sets up
+# .git/objects/info/alternates) and pull from it, so each remote is fetched
+# once per machine instead of once per install root.  Mirrors never prune
+# objects, since the clones depend on them.
+mirror_root  = os.environ.get('COPAS_MIRRORS')
+# A mirror fetched less than this many seconds ago is not fetched again,
+# as long as its branches still match the remote.
+mirror_fresh = 300
+
+# Mirror location for a repository URL, e.g. github.com/NCAR/lrose-core.git,
+# under root (default the shared mirror directory).
+def mirror_path(url, root=None):
+    location = url.split('://', 1)[-1]
+    location = location.split('@', 1)[-1].replace(':', '/')
+    if not location.endswith('.git'):
+        location += '.git'
+    return os.path.join(root or mirror_root, *[part for part in location.split('/') if part not in ('', '.', '..')])
+
+# Whether the branches and tags of the mirror in path are those of its
+# remote, one ls-remote compared with the mirror's own refs.  Any failure
+# counts as not current.
+def mirror_current(path):
+    import git
+    mirror = git.Git(path)
+    try:
+        remote = mirror.ls_remote('--heads', '--tags', 'origin')
+        local = mirror.for_each_ref('--format=%(objectname)\t%(refname)', 'refs/heads', 'refs/tags')
+    except git.exc.GitCommandError:
+        return False
+    remote = [line for line in remote.splitlines() if not line.endswith('^{}')]
+    return sorted(remote) == sorted(local.splitlines())
+
+# Create or fetch the mirror of url, holding a lock file so several CoPAS
+# runs (from other install roots) do not update it at the same time.  With
+# force (the remote is known to have moved) a recent fetch is not enough.
+# The growth of the mirror's objects counts as the bytes received.
+def update_mirror(url, log, root=None, force=False):
+    import git
+    path = mirror_path(url, root)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path+'.lock', 'w') as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
         except ImportError:
-            print ("    Required python 'sys' module is not installed.")
-            quit()
-    print ("    Finished tesing for non-installed ADPAA support packages.")
-
-
-### Airborne Data Testing and Evaluation (ADTAE) software package. ###
-if (adtae):
-    # Create main ADTAE directory.
-    print ("  Working on Airborne Data Testing and Evaluation (ADTAE) package.")
-    if not os.path.isdir("ADTAE"):
-        os.mkdir('ADTAE')
-        print ("    Cloning ADTAE repository.")
-        sourceforge_user = os.environ.get('SOURCEFORGE_USER')
-        if sourceforge_user is None:
-            repo = git.Repo.clone_from(
-                'git://git.code.sf.net/p/adtae/code',
-                'ADTAE',
-                progress=Progress())
+            pass
+        stamp = os.path.join(path, 'copas-fetched')
+        if not os.path.isdir(path):
+            log("    Creating shared mirror "+path+".")
+            git.Git().clone('--mirror', url, path)
+            count_bytes(git_object_bytes(path))
+            mirror = git.Git(path)
+            mirror.config('gc.pruneExpire', 'never')
+            mirror.config('remote.origin.prune', 'false')
+        elif (not force and os.path.exists(stamp) and
+                time.time() - os.path.getmtime(stamp) < mirror_fresh and mirror_current(path)):
+            log("    Shared mirror fetched recently, not fetching again.")
+            return path
         else:
-            repo = git.Repo.clone_from(
-                'ssh://'+sourceforge_user+'@git.code.sf.net/p/adtae/code',
-                'ADTAE')
-        print ("    Finished cloning ADTAE repository.")
-    else:
-        # Update the existing repository.
-        print ("    Updating ADTAE repository.")
-        repo = git.cmd.Git('ADTAE')
-        repo.pull()
-        print ("    Finished with ADTAE.")
-
-if (aospy):
-    print ("    Installing AOSPY package.")
-    print ("    WARNING:  AOSPY installation requires sudo excutation of CoPAS, for example 'sudo ./CoPAS'.")
-    def install(package):
-        pip.main(['install', package])
-    if __name__ == '__main__':
-        install('aospy')
-    print ("    Finsihed installing AOSPY package.")
-
-
-### Drawing Rich Integrated Lat-lon-time Subsets from Dataservers Online into Working Notebooks package. ###
-if (drilsdown):
-    # Create main DRILSDOWN directory.
-    print ("  Working on DRILSDOWN package.")
-    if not os.path.isdir("DRILSDOWN"):
-        os.mkdir('DRILSDOWN')
-        print ("    Cloning DRILSDOWN repository.")
-        repo = git.Repo.clone_from(
-            'git://github.com/Unidata/drilsdown.git',
-            'DRILSDOWN',
-            progress=Progress())
-        print ("    Finished cloning DRILSDOWN repository.")
-    else:
-        # Update the existing repository.
-        print ("    Updating GRILSDOWN repository.")
-        repo = git.cmd.Git('DRILSDOWN')
-        repo.pull()
-        print ("    Finished with DRILSDOWN.")
-
-
-### EUFAR General Airborne Data-processing Software (EUFAR). ###
-if (eufar):
-    # Create main EUFAR directory.
-    print ("  Working on EUFAR General Airborne Data-processing Software (EUFAR) package.")
-    if not os.path.isdir("EUFAR"):
-        os.mkdir('EUFAR')
-        print ("    Cloning EUFAR repository.")
-        repo = git.Repo.clone_from(
-            'https://github.com/eufarn7sp/egads-eufar',
-            'EUFAR',
-            progress=Progress())
-    else:
-        # Update the existing repository.
-        print ("    Updating EUFAR repository.")
-        repo = git.cmd.Git('EUFAR')
-        repo.pull()
-        print ("    Finished with EUFAR.")
-
-
-### LROSE Lidar Radar Open Software Environment (LROSE). ###
-if (lrose):
-    # Create main LROSE directory.
-    print ("  Working on the LROSE Lidar Radar Open Software Environment (LROSE).")
-    if not os.path.isdir("LROSE"):
-        os.mkdir('LROSE')
-        print ("    Cloning LROSE repository.")
-        repo = git.Repo.clone_from(
-            'https://github.com/NCAR/lrose-core',
-            'LROSE',
-            progress=Progress())
-    else:
+            log("    Fetching shared mirror "+path+".")
+            before = git_object_bytes(path)
+            git.Git(path).fetch('origin')
+            count_bytes(max(git_object_bytes(path) - before, 0))
+        with open(stamp, 'w') as stamp_file:
+            stamp_file.write(time.ctime()+'\n')
+    return path
+
+# Directory of the mirrors --fetch-only clones packages not installed yet
+# into, for --apply to clone from: the shared mirrors, or the cache.
+def fetch_mirror_root():
+    return mirror_root or os.path.join(cache_directory, 'mirrors')
+
+# Whether a git package with this clone strategy uses the shared mirror.
+# Shallow clones keep fetching directly, they only need the newest commits.
+def uses_mirror(strategy):
+    return mirror_root is not None and not strategy.startswith('shallow')
+
+# Whether the upstream branch of the clone in directory has moved since the
+# last pull: one ls-remote of that branch, compared with the remote tracking
+# ref, which the clone must already contain.  Any failure counts as changed.
+def git_changed(directory):
+    import git
+    repo = git.cmd.Git(directory)
+    try:
+        upstream = repo.rev_parse('--abbrev-ref', '@{upstream}')
+        remote, branch = upstream.split('/', 1)
+        heads = repo.ls_remote(remote, 'refs/heads/'+branch).split()
+        if not heads or heads[0] != repo.rev_parse('@{upstream}'):
+            return True
+        repo.merge_base('--is-ancestor', '@{upstream}', 'HEAD')
+    except (git.exc.GitCommandError, ValueError):
+        return True
+    return False
+
+# Size in bytes of the objects stored in the git repository in directory
+# (loose and packed, not counting alternates).  The growth over a clone or
+# pull stands in for the bytes fetched, which git does not report.
+def git_object_bytes(directory):
+    import git
+    try:
+        counts = git.cmd.Git(directory).count_objects('-v')
+    except git.exc.GitCommandError:
+        return 0
+    values = dict(line.split(': ', 1) for line in counts.splitlines() if ': ' in line)
+    return (int(values.get('size', 0)) + int(values.get('size-pack', 0)))*1024
+
+# Fetch the shared mirror of package, then the clone's remote tracking
+# refs from the mirror.
+def fetch_from_mirror(package, repo, log, force=False):
+    mirror_start = time.time()
+    mirror = update_mirror(package.url, log, force=force)
+    time_phase('mirror', time.time() - mirror_start)
+    repo.fetch(mirror, '+refs/heads/*:refs/remotes/origin/*', '--tags')
+
+# Step for cloning a new git repository or pulling an existing one.  With
+# changed false the remote has nothing new and the step only says so.
+def git_step(package, changed=True):
+    directory = package.directory
+    if not os.path.isdir(directory):
+        strategy = clone_strategy(package.name)
+        def clone(log, progress, strategy=strategy):
+            if package.bundle is not None:
+                strategy = 'full'
+                log("    Cloning "+package.name+" repository from the offline bundle.")
+            elif strategy == 'full':
+                log("    Cloning "+package.name+" repository.")
+            else:
+                log("    Cloning "+package.name+" repository ("+strategy+").")
+            import git
+            progress = make_progress(progress)
+            if package.bundle is not None:
+                # Clone from the offline bundle, then point origin upstream.
+                repo = git.Repo.clone_from(package.bundle, directory, progress=progress)
+                repo.git.remote('set-url', 'origin', package.url)
+            elif uses_mirror(strategy) or phase == 'apply':
+                # Clone at local disk speed, borrowing the mirror's objects.
+                # With --apply the mirror --fetch-only made is used as it is;
+                # without shared mirrors the clone gets its own (hard linked)
+                # copy of the objects, with full history.
+                if phase == 'apply':
+                    mirror = mirror_path(package.url, fetch_mirror_root())
+                    if not os.path.isdir(mirror):
+                        raise IOError(package.name+" was not fetched, run CoPAS.py --fetch-only first.")
+                    if not uses_mirror(strategy) and not strategy.startswith('sparse:'):
+                        strategy = 'full'
+                else:
+                    mirror_start = time.time()
+                    mirror = update_mirror(package.url, log)
+                    time_phase('mirror', time.time() - mirror_start)
+                repo = git.Repo.clone_from(mirror, directory, progress=progress,
+                                           shared=uses_mirror(strategy),
+                                           no_checkout=strategy.startswith('sparse:'))
+                repo.git.remote('set-url', 'origin', package.url)
+                if uses_mirror(strategy):
+                    repo.git.config('copas.mirror', mirror)
+                if strategy.startswith('sparse:'):
+                    repo.git.sparse_checkout('set', *strategy[7:].split(','))
+                    repo.git.checkout()
+            else:
+                repo = git.Repo.clone_from(package.url, directory, progress=progress,
+                                           **clone_options(strategy))
+                count_bytes(git_object_bytes(directory))
+                if strategy.startswith('sparse:'):
+                    repo.git.sparse_checkout('set', *strategy[7:].split(','))
+            # Remember the strategy; git itself keeps the shallow and partial
+            # state, so later pulls only fetch the new commits.
+            repo.git.config('copas.clonestrategy', strategy)
+            log("    Finished cloning "+package.name+" repository.")
+        return Step(package.name, 'checkout', clone)
+    if not changed:
+        def current(log, progress):
+            log("    "+package.name+" repository is already up to date, not pulling.")
+        return Step(package.name, 'pull', current)
+    def pull(log, progress):
         # Update the existing repository.
-        print ("    Updating LROSE repository.")
-        repo = git.cmd.Git('LROSE')
-        repo.pull()
-        print ("    Finished with LROSE.")
-
-    # Create main NetCDF directory.
-    print ("  Working on the NetCDF support for (LROSE).")
-    if not os.path.isdir("NetCDF"):
-        os.mkdir('NetCDF')
-        print ("    Cloning NetCDF repository.")
-        repo = git.Repo.clone_from(
-            'https://github.com/NCAR/lrose-netcdf',
-            'NetCDF',
-            progress=Progress())
+        log("    Updating "+package.name+" repository.")
+        import git
+        repo = git.cmd.Git(directory)
+        try:
+            strategy = repo.config('--get', 'copas.clonestrategy')
+        except git.exc.GitCommandError:
+            strategy = 'full'
+        if package.bundle is not None:
+            # Fast-forward from the offline bundle.
+            repo.fetch(package.bundle, '+refs/heads/*:refs/remotes/origin/*')
+            repo.merge('@{upstream}')
+        elif phase == 'apply':
+            # The objects were fetched by --fetch-only, only fast-forward.
+            repo.merge('--ff-only', '@{upstream}')
+        elif uses_mirror(strategy):
+            # Fetch the mirror once, then update from it at local disk speed.
+            # The pull only runs when the remote moved (or with nocheck),
+            # so a recent fetch of the mirror is not enough.
+            fetch_from_mirror(package, repo, log, force=True)
+            repo.merge('@{upstream}')
+        else:
+            before = git_object_bytes(directory)
+            repo.pull()
+            count_bytes(max(git_object_bytes(directory) - before, 0))
+        log("    Finished updating "+package.name+" repository.")
+    return Step(package.name, 'pull', pull)
+
+# Steps for git repositories.  Existing clones first ask their remotes,
+# all at once, whether anything changed, so a run with nothing new makes one
+# small request per repository instead of a full pull.
+def git_steps(packages):
+    existing = [package for package in packages
+                if os.path.isdir(package.directory) and package.bundle is None]
+    changed = {}
+    if remote_check and phase != 'apply' and existing:
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(existing)) as executor:
+            for package, result in zip(existing, executor.map(git_changed,
+                                       [package.directory for package in existing])):
+                changed[package.name] = result
+        print ("  Checked %d git remotes in %.1f s, %d changed." %
+               (len(existing), time.time()-start, sum(changed.values())))
+    return [git_step(package, changed.get(package.name, True)) for package in packages]
+
+# Steps for packages installed with pip.
+def pip_steps(packages):
+    steps = []
+    for package in packages:
+        def install(log, progress, package=package):
+            log("    Installing "+package.name+" package.")
+            log("    WARNING:  "+package.name+" installation requires sudo excutation of CoPAS, for example 'sudo ./CoPAS'.")
+            import pip
+            pip.main(['install', package.url])
+            log("    Finsihed installing "+package.name+" package.")
+        steps.append(Step(package.name, 'install', install))
+    return steps
+
+### Data set mirrors. ###
+# Data sets such as SIMDATA are directories of files on an FTP (or HTTP)
+# server.  The remote listing (names, sizes and mtimes) is compared with the
+# manifest of the local copy and only new or changed files are downloaded,
+# dataset_workers at a time; files gone from the server are removed.  The
+# transport is looked up by URL scheme in dataset_transports, so a data set
+# can also be mirrored from a local stand-in server (COPAS_URL_SIMDATA).
+dataset_workers = 4
+
+# Seconds since the epoch of an FTP MLSD or MDTM time, YYYYMMDDHHMMSS UTC.
+def ftp_time(value):
+    if not value:
+        return None
+    import calendar
+    return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+# Transport for ftp:// URLs on ftplib.  Every worker thread gets an FTP
+# connection of its own, ftplib connections are not thread safe.
+class FTPTransport:
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host     = parts.hostname
+        self.port     = parts.port or 21
+        self.user     = urllib.parse.unquote(parts.username or 'anonymous')
+        self.password = urllib.parse.unquote(parts.password or 'anonymous@')
+        self.root     = urllib.parse.unquote(parts.path).rstrip('/')
+        self.local    = threading.local()
+        self.lock     = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        ftp = getattr(self.local, 'ftp', None)
+        if ftp is None:
+            import ftplib
+            ftp = ftplib.FTP(timeout=http_timeout[1])
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.password)
+            ftp.voidcmd('TYPE I')
+            self.local.ftp = ftp
+            with self.lock:
+                self.connections.append(ftp)
+        return ftp
+
+    # All files below the root as {relative name: (size, mtime)}.
+    def listing(self):
+        files = {}
+        self.walk('', files)
+        return files
+
+    def walk(self, directory, files):
+        import ftplib
+        ftp = self.connection()
+        path = '/'.join(part for part in (self.root, directory) if part) or '/'
+        try:
+            entries = list(ftp.mlsd(path, ['type', 'size', 'modify']))
+        except ftplib.error_perm:
+            # No MLSD on this server, ask for each name's size and time.
+            entries = []
+            for name in ftp.nlst(path):
+                name = name.rstrip('/').rpartition('/')[2]
+                try:
+                    size = ftp.size(path+'/'+name)
+                    modify = ftp.sendcmd('MDTM '+path+'/'+name)[4:].strip()
+                    entries.append((name, {'type': 'file', 'size': size, 'modify': modify}))
+                except ftplib.error_perm:
+                    entries.append((name, {'type': 'dir'}))
+        for name, facts in entries:
+            if name in ('.', '..'):
+                continue
+            relative = directory+'/'+name if directory else name
+            if facts.get('type') == 'dir':
+                self.walk(relative, files)
+            elif facts.get('type') == 'file':
+                files[relative] = (int(facts.get('size', -1)), ftp_time(facts.get('modify')))
+
+    # Pass the contents of the file name to write, in pieces.
+    def fetch(self, name, write):
+        self.connection().retrbinary('RETR '+self.root+'/'+name, write, blocksize=64*1024)
+
+    def close(self):
+        for ftp in self.connections:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+# Links (href values) of an HTML page.
+def page_links(text):
+    import html.parser
+    links = []
+    class Parser(html.parser.HTMLParser):
+        def handle_starttag(self, tag, attrs):
+            if tag == 'a':
+                links.extend(value for key, value in attrs if key == 'href' and value)
+    Parser().feed(text)
+    return links
+
+# Transport for http:// and https:// URLs of directory index pages, through
+# the shared HTTP session.  Sizes and mtimes come from HEAD requests.
+class HTTPTransport:
+    def __init__(self, url):
+        self.root = url if url.endswith('/') else url+'/'
+
+    def listing(self):
+        names = []
+        self.walk(self.root, names)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=dataset_workers) as pool:
+            return dict(zip(names, pool.map(self.head, names)))
+
+    def walk(self, url, names):
+        with host_slot(url):
+            response = http_get(url)
+            try:
+                response.raise_for_status()
+                text = response.text
+            finally:
+                response.close()
+        for link in page_links(text):
+            target = urllib.parse.urljoin(url, link)
+            if '?' in target or '#' in target or not target.startswith(url) or target == url:
+                continue
+            if target.endswith('/'):
+                self.walk(target, names)
+            else:
+                names.append(urllib.parse.unquote(target[len(self.root):]))
+
+    def head(self, name):
+        import email.utils
+        url = self.root+urllib.parse.quote(name)
+        with host_slot(url):
+            response = get_http_session().head(url, timeout=http_timeout, allow_redirects=True)
+        response.raise_for_status()
+        modified = response.headers.get('Last-Modified')
+        return (int(response.headers.get('Content-Length', -1)),
+                email.utils.parsedate_to_datetime(modified).timestamp() if modified else None)
+
+    def fetch(self, name, write):
+        url = self.root+urllib.parse.quote(name)
+        with host_slot(url):
+            response = http_get(url)
+            try:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=64*1024):
+                    write(chunk)
+            finally:
+                response.close()
+
+    def close(self):
+        pass
+
+dataset_transports = {
+    'ftp':   FTPTransport,
+    'http':  HTTPTransport,
+    'https': HTTPTransport,
+}
+
+# Manifest of the local copy of a data set: {name: {size, mtime, sha256}}.
+def dataset_manifest(package):
+    return os.path.join(package.directory, '.copas-manifest.json')
+
+# Bring the local copy of the data set package up to date with its server.
+def mirror_dataset(package, log):
+    scheme = urllib.parse.urlsplit(package.url).scheme
+    if scheme not in dataset_transports:
+        raise ValueError("No transport for "+package.url+".")
+    transport = dataset_transports[scheme](package.url)
+    if not os.path.isdir(package.directory):
+        os.makedirs(package.directory)
+    manifest_name = dataset_manifest(package)
+    manifest = read_json(manifest_name)
+    lock = threading.Lock()
+    step = current_step()
+    try:
+        start = time.time()
+        remote = transport.listing()
+        log("    Listed %d remote files in %.1f s." % (len(remote), time.time() - start))
+        wanted = []
+        for name, (size, mtime) in sorted(remote.items()):
+            if any(part in ('', '.', '..') for part in name.split('/')):
+                continue
+            entry = manifest.get(name)
+            path = os.path.join(package.directory, *name.split('/'))
+            if (entry is None or entry['size'] != size or entry['mtime'] != mtime or
+                    not os.path.isfile(path)):
+                wanted.append(name)
+        removed = [name for name in manifest if name not in remote]
+        for name in removed:
+            path = os.path.join(package.directory, *name.split('/'))
+            if os.path.isfile(path):
+                os.remove(path)
+            del manifest[name]
+        expect_bytes(sum(max(remote[name][0], 0) for name in wanted))
+
+        def fetch(name):
+            path = os.path.join(package.directory, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            digest = hashlib.sha256()
+            with open(path+'.copas-tmp', 'wb') as output:
+                def write(data):
+                    output.write(data)
+                    digest.update(data)
+                    count_bytes(len(data), step)
+                transport.fetch(name, write)
+            size, mtime = remote[name]
+            if mtime is not None:
+                os.utime(path+'.copas-tmp', (mtime, mtime))
+            os.replace(path+'.copas-tmp', path)
+            with lock:
+                manifest[name] = {'size': size, 'mtime': mtime, 'sha256': digest.hexdigest()}
+                write_json(manifest_name, manifest)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=dataset_workers) as pool:
+            for future in [pool.submit(fetch, name) for name in wanted]:
+                future.result()
+    finally:
+        transport.close()
+        write_json(manifest_name, manifest)
+    log("    Downloaded %d new or changed files, kept %d unchanged, removed %d." %
+        (len(wanted), len(remote) - len(wanted), len(removed)))
+
+# Steps for data sets on FTP sites.
+def ftp_steps(packages):
+    steps = []
+    for package in packages:
+        def download(log, progress, package=package):
+            log("    Updating "+package.name+" data set from "+package.url+".")
+            mirror_dataset(package, log)
+            log("    Finished updating "+package.name+" data set.")
+        steps.append(Step(package.name, 'download', download))
+    return steps
+
+# Step checking the python modules a package needs at run time.
+def verify_step(package):
+    def verify(log, progress):
+        log("    Tesing for non-installed "+package.name+" support packages.")
+        modules = package_requirements[package.name]
+        found = find_modules(modules)
+        missing = [module for module in modules if not found[module]]
+        if missing:
+            raise ImportError("Required python module(s) not installed: "+", ".join(missing)+".")
+        log("    Finished tesing for non-installed "+package.name+" support packages.")
+    return Step(package.name, 'verify', verify)
+
+### Install state. ###
+# The state file in the install root records, for each package, what was
+# installed (git commit, svn revision, archive SHA-256, extraction manifest
+# id), which parts (binary, source) were installed, when the package was
+# last checked against its remote and how long each step took.  A package
+# checked less than state_fresh seconds ago whose files still match the
+# state is not checked again, so a run with nothing to do stays local.
+state_path = '.copas-state.json'
+
+# Commit checked out in the git repository in directory, read from the
+# .git files without running git; None when it cannot be found.
+def git_head(directory):
+    git_directory = os.path.join(directory, '.git')
+    try:
+        with open(os.path.join(git_directory, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[5:]
+        if os.path.isfile(os.path.join(git_directory, ref)):
+            with open(os.path.join(git_directory, ref)) as ref_file:
+                return ref_file.read().strip()
+        with open(os.path.join(git_directory, 'packed-refs')) as packed_file:
+            for line in packed_file:
+                if line.rstrip().endswith(' '+ref):
+                    return line.split()[0]
+    except IOError:
+        pass
+    return None
+
+# Identifier of an extraction manifest: the SHA-256 of its contents.
+def manifest_id(manifest):
+    try:
+        with open(manifest, 'rb') as manifest_file:
+            return hashlib.sha256(manifest_file.read()).hexdigest()[:16]
+    except IOError:
+        return None
+
+# Whether package was checked recently and its installed files still match
+# the state, so it needs no steps in this run.
+def state_fresh_package(package, state):
+    entry = state.get('packages', {}).get(package.name)
+    if (entry is None or not remote_check or state_fresh <= 0 or phase == 'apply' or
+            package.bundle is not None or package.fetch not in ('git', 'http', 'ftp')):
+        return False
+    if time.time() - entry.get('checked', 0) >= state_fresh:
+        return False
+    if package.fetch == 'git':
+        return git_head(package.directory) == entry.get('revision')
+    if package.fetch == 'ftp':
+        return (entry.get('manifest') is not None and
+                manifest_id(dataset_manifest(package)) == entry['manifest'])
+    if binary:
+        values = read_json(archive_paths(package)[1])
+        if (not entry.get('binary') or not values.get('validator') or
+                values.get('validator') != entry.get('validator')):
+            return False
+    if source and package.source_url:
+        if not entry.get('source') or not os.path.isdir(os.path.join(package.directory, 'src')):
+            return False
+    return True
+
+# Step for a package found fresh in the state file.
+def fresh_step(package, entry):
+    def fresh(log, progress):
+        log("    "+package.name+" was checked %d s ago and is unchanged, not checking again." %
+            (time.time() - entry['checked']))
+    return Step(package.name, 'fresh', fresh)
+
+# Record the packages whose steps all finished in the state file.  Packages
+# installed from an offline bundle or with --apply keep their last check
+# time, neither says anything about the remote.
+def record_state(state, packages, steps):
+    records = state.setdefault('packages', {})
+    for package in packages:
+        own = [step for step in steps if step.package == package.name]
+        if not own or any(step.status != 'done' for step in own) or own[0].kind == 'fresh':
+            continue
+        entry = records.setdefault(package.name, {})
+        entry['durations'] = dict((step.kind, round(step.duration, 3)) for step in own)
+        if package.fetch == 'git':
+            entry['revision'] = git_head(package.directory)
+        elif package.fetch == 'ftp':
+            entry['manifest'] = manifest_id(dataset_manifest(package))
+        elif package.fetch == 'http':
+            archive, marker, manifest = archive_paths(package)
+            if binary:
+                values = read_json(marker)
+                entry['binary'] = True
+                entry['validator'] = values.get('validator')
+                entry['sha256'] = values.get('sha256')
+                entry['verified'] = values.get('verified', False)
+                entry['manifest'] = manifest_id(manifest)
+            if source and package.source_url:
+                entry['source'] = True
+                try:
+                    entry['source_revision'] = int(subprocess.check_output(
+                        ['svn', 'info', '--show-item', 'revision',
+                         os.path.join(package.directory, 'src')], stderr=subprocess.DEVNULL))
+                except (OSError, ValueError, subprocess.CalledProcessError):
+                    entry['source_revision'] = None
+        if package.bundle is None and phase != 'apply':
+            entry['checked'] = time.time()
+    state['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    write_json(state_path+'.tmp', state)
+    os.replace(state_path+'.tmp', state_path)
+
+# Step builders for each fetch type.  Each builder gets all selected
+# packages of its type at once, so work can be batched across packages.
+fetch_engines = {
+    'http': http_steps,
+    'git':  git_steps,
+    'pip':  pip_steps,
+    'ftp':  ftp_steps,
+}
+
+# Step builders used with --apply, for the fetch types that can be updated
+# from the local caches.
+apply_engines = {
+    'http': http_steps,
+    'git':  git_steps,
+}
+
+# Build the steps for the selected packages and connect them: a package's
+# first steps wait for the last steps of the packages it depends on, the
+# verify step waits for all other steps of its package, and the first step
+# of each package prints the package heading.  Packages that are fresh in
+# the install state get a single step saying so instead of their fetch steps.
+def plan_steps(packages, state=None):
+    steps = []
+    state = state or {}
+    fresh = [package for package in packages if state_fresh_package(package, state)]
+    for package in fresh:
+        steps.append(fresh_step(package, state['packages'][package.name]))
+    engines = apply_engines if phase == 'apply' else fetch_engines
+    for fetch, engine in sorted(engines.items()):
+        batch = [package for package in packages
+                 if package.fetch == fetch and package not in fresh]
+        if fetch == 'http' and not binary:
+            batch = []
+        if batch:
+            steps.extend(engine(batch))
+    if source and phase != 'apply':
+        steps.extend(svn_steps([package for package in packages
+                                if package.source_url and package not in fresh]))
+    if testing:
+        steps.extend([verify_step(package) for package in packages
+                      if package.name in package_requirements])
+    order = [package.name for package in packages]
+    steps.sort(key=lambda step: order.index(step.package))
+    names = set(step.name for step in steps)
+    for package in packages:
+        own = [step for step in steps if step.package == package.name]
+        if not own:
+            continue
+        for step in own:
+            if step.kind == 'verify':
+                step.depends = [other.name for other in own if other is not step]
+        internal = set(name for step in own for name in step.depends if name in names)
+        last = [step.name for step in own if step.name not in internal]
+        for dependent in packages:
+            if package.name in dependent.depends:
+                for step in steps:
+                    if step.package == dependent.name and not [
+                            name for name in step.depends if name in names]:
+                        step.depends.extend(last)
+        own[0].heading = package.heading
+    return steps
+
+### Offline bundles. ###
+# An offline bundle is an uncompressed tar file holding bundle.json (the
+# manifest of packages and revisions), a git bundle of every git package,
+# the cached archive of every http package and an svn export of the source
+# checkouts.  --export-bundle writes one from the current install root;
+# --from-bundle installs from one through the normal steps, with the bundle
+# files in place of the network.
+
+# Steps writing the bundle contents for the packages into staging and
+# recording them in the manifest.
+def export_steps(packages, staging, manifest):
+    steps = []
+    for package in packages:
+        if package.fetch == 'git':
+            def export_git(log, progress, package=package):
+                import git
+                if not os.path.isdir(package.directory):
+                    raise IOError(package.directory+" is not installed.")
+                repo = git.Git(package.directory)
+                name = os.path.join('git', package.name+'.bundle')
+                log("    Bundling "+package.name+" repository.")
+                repo.bundle('create', os.path.abspath(os.path.join(staging, name)), '--all')
+                manifest['packages'][package.name] = {
+                    'fetch': 'git', 'file': name,
+                    'revision': repo.rev_parse('HEAD'),
+                    'branch': repo.rev_parse('--abbrev-ref', 'HEAD')}
+            steps.append(Step(package.name, 'export', export_git, heading=package.heading))
+        elif package.fetch == 'http':
+            def export_http(log, progress, package=package):
+                archive, marker, manifest_name = archive_paths(package)
+                if not os.path.exists(archive):
+                    # Not kept in the install root (stream mode), use the cache.
+                    archive = os.path.join(cache_directory, package.artifact)
+                if not os.path.exists(archive):
+                    raise IOError(package.artifact+" is neither installed nor cached.")
+                name = os.path.join('artifacts', package.artifact)
+                log("    Adding "+package.artifact+" to the bundle.")
+                shutil.copyfile(archive, os.path.join(staging, name))
+                values = read_json(marker)
+                entry = {'fetch': 'http', 'file': name,
+                         'validator': values.get('validator'),
+                         'sha256': values.get('sha256')}
+                checkout_directory = os.path.join(package.directory, 'src')
+                if package.source_url and os.path.isdir(checkout_directory):
+                    log("    Exporting "+package.name+" source code.")
+                    source_name = os.path.join('source', package.name)
+                    subprocess.check_call(['svn', 'export', '--quiet', checkout_directory,
+                                           os.path.join(staging, source_name)])
+                    entry['source'] = source_name
+                    try:
+                        entry['revision'] = int(subprocess.check_output(
+                            ['svn', 'info', '--show-item', 'revision', checkout_directory],
+                            stderr=subprocess.DEVNULL))
+                    except (OSError, ValueError, subprocess.CalledProcessError):
+                        entry['revision'] = None
+                manifest['packages'][package.name] = entry
+            steps.append(Step(package.name, 'export', export_http, heading=package.heading))
+    return steps
+
+# Write an offline bundle of the selected packages to path.
+def export_bundle(path, packages):
+    import tempfile
+    staging = tempfile.mkdtemp(prefix='.copas-bundle-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        for name in ('git', 'artifacts', 'source'):
+            os.mkdir(os.path.join(staging, name))
+        manifest = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'packages': {}}
+        steps = export_steps(packages, staging, manifest)
+        start = time.time()
+        run_steps(steps, jobs)
+        print_step_summary(steps, time.time() - start)
+        if any(step.status != 'done' for step in steps):
+            print ("**  ERROR:  Not all packages could be exported, not writing "+path+".")
+            return steps
+        write_json(os.path.join(staging, 'bundle.json'), manifest)
+        print ("  Writing offline bundle "+path+".")
+        tar = tarfile.open(path+'.tmp', 'w')
+        for name in sorted(os.listdir(staging)):
+            tar.add(os.path.join(staging, name), name)
+        tar.close()
+        os.replace(path+'.tmp', path)
+    finally:
+        shutil.rmtree(staging)
+    return steps
+
+# Unpack an offline bundle into a staging directory and point the packages
+# at its files.  Returns the staging directory and the bundled packages.
+def load_bundle(path, packages):
+    import tempfile
+    staging = tempfile.mkdtemp(prefix='.copas-bundle-', dir='.')
+    tar = tarfile.open(path, 'r')
+    # The bundle comes from elsewhere; only plain files and directories
+    # inside the staging directory are taken from it.
+    for member in tar.getmembers():
+        parts = member.name.replace('\\', '/').split('/')
+        if (member.name.startswith('/') or '..' in parts or
+                not (member.isfile() or member.isdir())):
+            tar.close()
+            shutil.rmtree(staging)
+            raise IOError("Bundle "+path+" has an unsafe member "+member.name+".")
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(staging, filter='data')
     else:
-        # Update the existing repository.
-        print ("    Updating NetCDF repository.")
-        repo = git.cmd.Git('NetCDF')
-        repo.pull()
-        print ("    Finished with NetCDF.")
-
-
-### Software for Airborne Measurements of Aerosol and Clouds (SAMAC) ###
-if (samac):
-    # Create main SAMAC directory.
-    print ("  Software for Airborne Measurements of Aerosol and Clouds (SAMAC).")
-    if not os.path.isdir("SAMAC"):
-        print ("    Cloning SAMAC repository.")
-        # Add in two space without return.
-        sys.stdout.write('  ')
+        tar.extractall(staging)
+    tar.close()
+    manifest = read_json(os.path.join(staging, 'bundle.json'))
+    bundled = []
+    for package in packages:
+        entry = manifest.get('packages', {}).get(package.name)
+        if entry is None:
+            continue
+        package.bundle = os.path.abspath(os.path.join(staging, entry['file']))
+        package.bundle_info = entry
+        if entry.get('source'):
+            package.bundle_source = os.path.join(staging, entry['source'])
+        bundled.append(package)
+    return staging, bundled
+
+# Cache-style entry for an archive taken from an offline bundle.  The
+# archive is hashed here, the manifest's sha256 is only what the bundle
+# claims.
+def bundled_artifact(package):
+    info = package.bundle_info
+    digest = file_digest(package.bundle)
+    if info.get('sha256') and info['sha256'] != digest:
+        raise IOError(package.artifact+" in the bundle is corrupt, sha256 "+digest+
+                      " instead of "+info['sha256']+".")
+    return {'path': package.bundle,
+            'validator': info.get('validator') or digest,
+            'sha256': digest,
+            'changed': True}
+
+### Package versions. ###
+# Older versions of a git package (for example the SODA release a campaign
+# was processed with) are checked out next to the package, in PACKAGE@NAME,
+# as git worktrees of the package clone: all versions share its object
+# store, so adding one only writes the checked-out files.  A version is a
+# detached checkout of a tag, branch or commit, it is not pulled by normal
+# runs.
+
+# Directory of version name of package.
+def version_directory(package, name):
+    return package.directory+'@'+name
+
+# Steps adding and removing the versions, (package, ref, name) and
+# (package, name) pairs.
+def version_steps(additions, removals):
+    steps = []
+    for package, ref, name in additions:
+        def add(log, progress, package=package, ref=ref, name=name):
+            import git
+            directory = version_directory(package, name)
+            if not os.path.isdir(package.directory):
+                raise IOError(package.name+" is not installed, install it before adding versions.")
+            if os.path.exists(directory):
+                raise IOError(directory+" already exists.")
+            repo = git.cmd.Git(package.directory)
+            try:
+                commit = repo.rev_parse('--verify', '--quiet', ref+'^{commit}')
+            except git.exc.GitCommandError:
+                # Not known locally yet, fetch the new tags and branches.
+                log("    Fetching "+package.name+" to find "+ref+".")
+                try:
+                    strategy = repo.config('--get', 'copas.clonestrategy')
+                except git.exc.GitCommandError:
+                    strategy = 'full'
+                if uses_mirror(strategy):
+                    fetch_from_mirror(package, repo, log)
+                else:
+                    repo.fetch('origin', '--tags')
+                commit = None
+                for candidate in (ref, 'origin/'+ref):
+                    try:
+                        commit = repo.rev_parse('--verify', '--quiet', candidate+'^{commit}')
+                        break
+                    except git.exc.GitCommandError:
+                        pass
+                if commit is None:
+                    raise ValueError(package.name+" has no tag, branch or commit "+ref+".")
+            log("    Checking out "+package.name+" "+ref+" in "+directory+".")
+            repo.worktree('add', '--detach', os.path.abspath(directory), commit)
+        steps.append(Step(package.name+'@'+name, 'add', add, heading=package.heading))
+    for package, name in removals:
+        def remove(log, progress, package=package, name=name):
+            import git
+            directory = version_directory(package, name)
+            if not os.path.isdir(directory):
+                raise IOError(directory+" does not exist.")
+            log("    Removing "+directory+".")
+            repo = git.cmd.Git(package.directory)
+            repo.worktree('remove', os.path.abspath(directory))
+            repo.worktree('prune')
+        steps.append(Step(package.name+'@'+name, 'remove', remove, heading=package.heading))
+    return steps
+
+# Print the versions checked out for the git packages.
+def print_versions(packages):
+    import git
+    for package in packages:
+        if package.fetch != 'git' or not os.path.isdir(package.directory):
+            continue
+        repo = git.cmd.Git(package.directory)
+        versions = []
+        for block in repo.worktree('list', '--porcelain').split('\n\n'):
+            fields = dict(line.partition(' ')[::2] for line in block.splitlines())
+            path = fields.get('worktree', '')
+            prefix = os.path.basename(os.path.abspath(package.directory))+'@'
+            if os.path.basename(path).startswith(prefix):
+                versions.append((os.path.basename(path)[len(prefix):], fields.get('HEAD', '')))
+        print ("  "+package.name+" versions: "+(str(len(versions)) if versions else "none")+".")
+        for name, commit in versions:
+            try:
+                described = git.cmd.Git(version_directory(package, name)).describe('--tags', '--always')
+            except git.exc.GitCommandError:
+                described = commit[:12]
+            print ("    %-20s %s" % (name, described))
+
+### Background prefetch. ###
+# With --watch (or --daemon, the same detached from the terminal) CoPAS
+# keeps the local caches ahead of the install: every watch_interval seconds
+# it fetches the new objects of each existing git clone (into the remote
+# tracking refs, or the shared mirror) and the changed archives (into the
+# download cache, checked against their checksums).  Working trees,
+# extracted files and the install state are not touched, so a normal run
+# afterwards only merges and extracts what is already local.  svn has no
+# local store apart from the working copy, so svn updates are left to the
+# normal run.  A cycle with failures doubles the wait (up to a day), and
+# every wait is spread by watch_jitter so many hosts do not hit the servers
+# at the same moment.
+#
+# --fetch-only runs one such cycle, also mirroring the git packages not
+# cloned yet (into fetch_mirror_root) and the data sets, and --apply then
+# updates the installed packages from the local copies alone: clones are
+# fast-forwarded or cloned from the mirrors, archives extracted from the
+# download cache.  svn source checkouts and pip packages can only be
+# updated from the network and are left out of --apply.
+watch_jitter  = 0.1
+watch_backoff = 24*3600
+lock_name     = '.copas.lock'
+
+# Hold the install root lock, so a prefetch cycle and a normal run do not
+# work on the same clones at once.  Returns the open lock file (keep it
+# open while working), or None when blocking is false and it is taken.
+def lock_install_root(blocking):
+    lock_file = open(lock_name, 'w')
+    try:
+        import fcntl
+        fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except ImportError:
+        pass
+    except (IOError, OSError):
+        lock_file.close()
+        return None
+    return lock_file
+
+# Steps prefetching the packages into the local caches.
+def prefetch_steps(packages):
+    steps = []
+    for package in packages:
+        if package.fetch == 'git' and os.path.isdir(package.directory):
+            def fetch_git(log, progress, package=package):
+                import git
+                repo = git.cmd.Git(package.directory)
+                try:
+                    strategy = repo.config('--get', 'copas.clonestrategy')
+                except git.exc.GitCommandError:
+                    strategy = 'full'
+                log("    Fetching "+package.name+" repository.")
+                before = git_object_bytes(package.directory)
+                if uses_mirror(strategy):
+                    fetch_from_mirror(package, repo, log)
+                else:
+                    repo.fetch('origin', '--tags')
+                if strategy == 'partial' or strategy == 'blobless' or strategy.startswith('sparse:'):
+                    # A partial clone only has the file contents it checked
+                    # out; diffing against the new commits fetches the ones
+                    # the merge needs, so it does not fetch them itself.
+                    paths = strategy[7:].split(',') if strategy.startswith('sparse:') else []
+                    repo.diff('--stat', 'HEAD', '@{upstream}', '--', *paths)
+                count_bytes(max(git_object_bytes(package.directory) - before, 0))
+            steps.append(Step(package.name, 'prefetch', fetch_git, heading=package.heading))
+        elif package.fetch == 'git' and (mirror_root is not None or phase == 'fetch-only'):
+            def fetch_mirror(log, progress, package=package):
+                update_mirror(package.url, log, fetch_mirror_root())
+            steps.append(Step(package.name, 'prefetch', fetch_mirror, heading=package.heading))
+        elif package.fetch == 'http' and binary:
+            def fetch_archive(log, progress, package=package):
+                log("    Fetching "+package.artifact+" into the download cache.")
+                entry = cached_download(package.url, package.artifact, log)
+                try:
+                    mark_verified(package.url, verify_digest(package, entry.get('sha256'), log))
+                except IOError:
+                    discard_cached(package.url)
+                    raise
+            steps.append(Step(package.name, 'prefetch', fetch_archive, heading=package.heading))
+        elif package.fetch == 'ftp' and phase == 'fetch-only':
+            # A data set is nothing but its files, there is nothing to apply
+            # later, so --fetch-only mirrors it in place.
+            for step in ftp_steps([package]):
+                step.heading = package.heading
+                steps.append(step)
+    return steps
+
+# Detach from the terminal, sending the output to daemon.log in the cache
+# directory.
+def daemonize():
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    log_name = os.path.join(cache_directory, 'daemon.log')
+    print ("  Prefetching in the background, log in "+log_name+".")
+    sys.stdout.flush()
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    log_file = open(log_name, 'a')
+    null = open(os.devnull)
+    os.dup2(null.fileno(), 0)
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    progress_board.live = False
+
+# Prefetch the packages every watch_interval seconds, until interrupted.
+def watch(packages):
+    import random
+    failures = 0
+    while True:
+        print ("Prefetching at "+time.strftime('%Y-%m-%d %H:%M:%S')+":")
+        lock_file = lock_install_root(False)
+        if lock_file is None:
+            print ("  Another CoPAS run is working here, skipping this prefetch.")
+        else:
+            try:
+                steps = prefetch_steps(packages)
+                start = time.time()
+                run_steps(steps, jobs)
+                print_step_summary(steps, time.time() - start)
+            finally:
+                lock_file.close()
+            if any(step.status != 'done' for step in steps):
+                failures += 1
+            else:
+                failures = 0
+        delay = min(watch_interval * 2**min(failures, 16), max(watch_backoff, watch_interval))
+        delay *= random.uniform(1 - watch_jitter, 1 + watch_jitter)
+        print ("  Next prefetch in %d s." % delay)
         sys.stdout.flush()
-        repo = git.Repo.clone_from(
-            'https://github.com/StephGagne/SAMAC',
-            'SAMAC',
-            progress=Progress())
-        print ("    Finished cloning SAMAC.")
-    else:
-        # Update the existing repository.
-        print ("    Updating SAMAC repository.")
-        repo = git.cmd.Git('SAMAC')
-        repo.pull()
-        print ("    Finished updating SAMAC repository.")
-
-### Simulation probe data (SIMDATA)  ###
-if (simdata):
-    # Get from ftp.ucar.edu/pub/mmm/bansemer/simulations/
-    print ("  Downloading simuation probe data set.")
-    print ("  Finished downloading simuation probe data set.")
-
-
-### System for OAP Data Analysis (SODA) ###
-if (soda):
-    # Create main SODA directory.
-    print ("  System for OAP Data Analysis (SODA) package.")
-    if not os.path.isdir("SODA"):
-        print ("    Cloning SODA repository.")
-        repo = git.Repo.clone_from(
-            'https://github.com/abansemer/soda2',
-            'SODA',
-            progress=Progress())
-        print ("    Finished cloning SODA repository.")
-    else:
-        # Update the existing repository.
-        print ("    Updating SODA repository.")
-        repo = git.cmd.Git('SODA')
-        repo.pull()
-        print ("    Finished with SODA.")
-
-
-### Process University of Illinois OAP Processing Software (UOIPS) package ###
-if (uiops):
-    # Create main UOIPS directory.
-    print ("  UIOPS  Process University of Illinois OAP Processing Software (UOIPS) package.")
-    if not os.path.isdir("UIOPS"):
-        print ("    Cloning UIOPS repository.")
-        repo = git.Repo.clone_from(
-            'https://github.com/joefinlon/UIOPS',
-            'UIOPS',
-            progress=Progress())
-        print ("    Finished cloning UIPOS repository.")
-    else:
-        # Update the existing repository.
-        print ("    Updating UIOPS repository.")
-        repo = git.cmd.Git('UIOPS')
-        repo.pull()
-        print ("    Finished updating UIOPS.")
-
-
-### Process Coyote (IDL) Graphics Package ###
-if (coyote):
-    # Create main Coyote Directory.
-    print ("  Coyote (IDL) Graphics Package.")
-    if not os.path.isdir("Coyote"):
-        print ("    Cloning Coyote repository.")
-        repo = git.Repo.clone_from(
-            "https://github.com/idl-coyote/coyote",
-            "Coyote",
-        progress=Progress())
-        print ("    Finished cloning Coyote repository.")
-    else:
-        # Update the exisiting repository.
-        print("   Updating Coyote repository.")
-        repo = git.cmd.Git("Coyote")
-        repo.pull()
-        print ("   Finished updating Coyote")
-
+        time.sleep(delay)
+
+
+if export_path is not None:
+    print ("Exporting Offline Bundle:")
+    steps = export_bundle(export_path, selected)
+    if any(step.status != 'done' for step in steps):
+        sys.exit(1)
+    sys.exit(0)
+
+if version_adds or version_removes or list_versions:
+    print ("Package Versions:")
+    root_lock = lock_install_root(True)
+    steps = version_steps(version_adds, version_removes)
+    if steps:
+        start = time.time()
+        run_steps(steps, jobs)
+        print_step_summary(steps, time.time() - start)
+    if list_versions:
+        print_versions(selected)
+    if any(step.status != 'done' for step in steps):
+        sys.exit(1)
+    sys.exit(0)
+
+bundle_staging = None
+if bundle_path is not None:
+    print ("Installing from Offline Bundle "+bundle_path+":")
+    try:
+        bundle_staging, bundled = load_bundle(bundle_path, selected)
+    except (IOError, tarfile.TarError) as exc:
+        print ("**  ERROR:  "+str(exc))
+        exit(1)
+    if not named_packages:
+        # Without package names install everything in the bundle.
+        selected = select_packages([package.name for package in bundled])
+
+if watch_interval is not None:
+    if daemon:
+        daemonize()
+    try:
+        watch(selected)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+if phase == 'fetch-only':
+    print ("Fetching Packages:")
+elif phase == 'apply':
+    print ("Applying Fetched Packages:")
+    for package in selected:
+        if package.fetch not in apply_engines or (source and package.source_url):
+            print ("  "+package.name+(" source" if package.fetch in apply_engines else "")+
+                   " is only updated from the network, not applying it.")
+else:
+    print ("Cloning and Updating Repositories:")
+root_lock = lock_install_root(False)
+if root_lock is None:
+    print ("  Waiting for the background prefetch to finish.")
+    root_lock = lock_install_root(True)
+state = read_json(state_path)
+if phase == 'fetch-only':
+    steps = prefetch_steps(selected)
+else:
+    steps = plan_steps(selected, state)
+start = time.time()
+try:
+    run_steps(steps, jobs)
+    if phase != 'fetch-only':
+        record_state(state, selected, steps)
+finally:
+    if bundle_staging is not None:
+        shutil.rmtree(bundle_staging)
+elapsed = time.time() - start
+print_step_summary(steps, elapsed)
+print_phase_summary(steps, probe_time)
+if report_path is not None:
+    write_report(report_path, steps, elapsed, probe_time)
+if any(step.status != 'done' for step in steps):
+    sys.exit(1)
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+"""
+NAME:
+  CoPAS_benchmark.py <https://github.com/daviddelene/CoPAS>
+
+PURPOSE:
+  To measure CoPAS.py performance reproducibly, without GitHub or
+  SourceForge.  The benchmark creates local stand-ins for the package
+  sources: bare git repositories of realistic size, a file:// svn
+  repository for the ADPAA source and a local HTTP server with a synthetic
+  ADPAA.tar.gz and SIMDATA directory.  CoPAS.py is pointed at them with the
+  COPAS_URL_<NAME> and COPAS_SOURCE_URL_<NAME> overrides and run for each
+  scenario and package set, reporting wall time, bytes received and peak
+  memory.
+
+EXECUTION EXAMPLE:
+  Run all package sets and save the results as a baseline:
+    CoPAS_benchmark.py --save baseline.json
+  Compare the current CoPAS.py against the baseline:
+    CoPAS_benchmark.py --baseline baseline.json
+  Benchmark only the git packages at a tenth of the normal size:
+    CoPAS_benchmark.py --scale 0.1 git
+
+SYNTAX:
+  CoPAS_benchmark.py <-h> <--scale X> <--runs N> <--keep DIR> <--save FILE> <--baseline FILE> <SET ...>
+  <-h>             - Print Syntax message.
+  <--scale X>      - Multiply the size of the stand-in repositories and
+                     archive by X (default 1).
+  <--runs N>       - Run every scenario N times and report the median
+                     (default 1).
+  <--keep DIR>     - Build the stand-ins and install roots in DIR and keep
+                     them, instead of a removed temporary directory.
+  <--save FILE>    - Write the results as JSON to FILE.
+  <--baseline FILE> - Compare the wall times with results saved earlier.
+  SET              - Package sets to run: git, adpaa, adpaa-source,
+                     simdata, all (default these five), and the download
+                     sets adpaa-segments, adpaa-noranges, adpaa-resume,
+                     adpaa-segments-resume and adpaa-prefetch.
+
+SCENARIOS:
+  cold  - Empty install root and empty download cache.
+  warm  - Empty install root, download cache left by the cold run.
+  noop  - Rerun in the warm install root, nothing changed upstream; every
+          remote is checked (--fresh 0).
+  fresh - Rerun in the same install root within the freshness window, so
+          the install state answers without any remote check.
+  prefetched - (adpaa-prefetch only) A new ADPAA.tar.gz is released, a
+          --fetch-only run (one --watch cycle) puts it in the download
+          cache, then a normal run installs it; the run fails unless the
+          installed VERSION file is the new one.
+
+DOWNLOAD SETS:
+  adpaa-segments        - ADPAA over 4 connections (--segments 4).
+  adpaa-noranges        - As adpaa-segments, the server ignoring Range, so
+                          CoPAS.py falls back to one stream.
+  adpaa-resume          - ADPAA with the first of every two transfers cut
+                          off half way, so CoPAS.py resumes the partial file.
+  adpaa-segments-resume - As adpaa-segments, the first of every three
+                          transfers cut off.
+  adpaa-prefetch        - ADPAA, cold and prefetched scenarios.
+  The archive must be at least 2 MB (about --scale 0.1) to be segmented.
+  Its SHA-256 is pinned (COPAS_SHA256_ADPAA), so a badly resumed download
+  fails the run.
+
+NOTES:
+  The adpaa-source set needs the svnadmin and svn commands and is skipped
+  without them.  CoPAS.py runs with the notesting preference, so missing
+  support modules do not fail the runs.
+"""
+
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+copas = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CoPAS.py')
+
+# Size in megabytes and number of commits of the stand-in git repositories,
+# roughly in proportion to the real ones.
+git_packages = {
+    'ADTAE':     (20, 6),
+    'DRILSDOWN': (4, 4),
+    'EUFAR':     (6, 6),
+    'NetCDF':    (12, 4),
+    'LROSE':     (40, 8),
+    'SAMAC':     (2, 3),
+    'SODA':      (4, 4),
+    'UIOPS':     (2, 3),
+    'Coyote':    (6, 4),
+}
+# Size in megabytes of the synthetic ADPAA.tar.gz contents, of the svn
+# source tree and of the SIMDATA files.
+adpaa_size   = 50
+source_size  = 10
+simdata_size = 20
+
+# CoPAS.py arguments of each package set.
+package_sets = {
+    'git':          list(git_packages),
+    'adpaa':        ['ADPAA'],
+    'adpaa-source': ['-S', 'ADPAA'],
+    'simdata':      ['SIMDATA'],
+    'all':          [],
+    'adpaa-segments':        ['--segments', '4', 'ADPAA'],
+    'adpaa-noranges':        ['--segments', '4', 'ADPAA'],
+    'adpaa-resume':          ['ADPAA'],
+    'adpaa-segments-resume': ['--segments', '4', 'ADPAA'],
+    'adpaa-prefetch':        ['ADPAA'],
+}
+default_sets = ['git', 'adpaa', 'adpaa-source', 'simdata', 'all']
+# HTTP server behaviour of the package sets that need a different one:
+# whether it answers Range requests and every how many transfers it cuts
+# one off (0 never).
+server_settings = {
+    'adpaa-noranges':        (False, 0),
+    'adpaa-resume':          (True, 2),
+    'adpaa-segments-resume': (True, 3),
+}
+scenarios = ['cold', 'warm', 'noop', 'fresh']
+# Scenarios of the package sets that do not run the ones above.
+set_scenarios = {
+    'adpaa-prefetch': ['cold', 'prefetched'],
+}
+
+def help_message():
+    print (__doc__.split('SYNTAX:')[1].split('SCENARIOS:')[0].rstrip())
+
+# Write files of text lines (hex digits, which compress about as well as
+# source code) totalling size bytes into directory.
+def write_files(directory, size, generator, prefix='file'):
+    count = max(1, int(size // (256*1024)))
+    for index in range(count):
+        path = os.path.join(directory, 'dir%02d' % (index % 16), prefix+'%04d.txt' % index)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as output:
+            for line in range(size // count // 65):
+                output.write('%064x\n' % generator.getrandbits(256))
+
+def git(directory, *args):
+    subprocess.check_call(['git', '-C', directory] + list(args),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# Create the bare repository root/git/name.git with size megabytes spread
+# over commits commits, and return its file:// URL.
+def make_git_repository(root, name, size, commits, generator):
+    work = os.path.join(root, 'work', name)
+    os.makedirs(work)
+    git(work, 'init', '-q', '-b', 'master')
+    for commit in range(commits):
+        write_files(work, int(size*1024*1024 / commits), generator, 'commit%d-' % commit)
+        git(work, 'add', '-A')
+        git(work, '-c', 'user.name=CoPAS Benchmark', '-c', 'user.email=benchmark@localhost',
+            'commit', '-q', '-m', 'Commit %d' % commit)
+    bare = os.path.join(root, 'git', name+'.git')
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work, bare],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Allow the partial and sparse clone strategies.
+    git(bare, 'config', 'uploadpack.allowFilter', 'true')
+    shutil.rmtree(work)
+    return 'file://'+bare
+
+# Create root/http/ADPAA.tar.gz with a bin and src tree of size megabytes.
+def make_adpaa_archive(root, size, generator):
+    tree = os.path.join(root, 'work', 'ADPAA')
+    write_files(os.path.join(tree, 'bin'), int(size*1024*1024*0.3), generator, 'tool')
+    write_files(os.path.join(tree, 'src'), int(size*1024*1024*0.7), generator, 'source')
+    os.makedirs(os.path.join(root, 'http'))
+    with tarfile.open(os.path.join(root, 'http', 'ADPAA.tar.gz'), 'w:gz') as tar:
+        for name in sorted(os.listdir(tree)):
+            tar.add(os.path.join(tree, name), name)
+    shutil.rmtree(tree)
+
+# Rewrite root/http/ADPAA.tar.gz with a VERSION file holding version, as an
+# upstream release would, and return the SHA-256 of the new archive.
+def release_adpaa_archive(root, version):
+    path = os.path.join(root, 'http', 'ADPAA.tar.gz')
+    with tarfile.open(path) as old, tarfile.open(path+'.new', 'w:gz') as new:
+        for member in old:
+            if member.name != 'VERSION':
+                new.addfile(member, old.extractfile(member) if member.isfile() else None)
+        data = version.encode()
+        info = tarfile.TarInfo('VERSION')
+        info.size = len(data)
+        info.mtime = time.time()
+        new.addfile(info, io.BytesIO(data))
+    os.replace(path+'.new', path)
+    with open(path, 'rb') as archive:
+        return hashlib.sha256(archive.read()).hexdigest()
+
+# Create a file:// svn repository with the ADPAA source tree and return the
+# URL of its trunk/src, or None without the svn commands.
+def make_svn_repository(root, size, generator):
+    if shutil.which('svnadmin') is None or shutil.which('svn') is None:
+        return None
+    repository = os.path.join(root, 'svn')
+    subprocess.check_call(['svnadmin', 'create', repository])
+    tree = os.path.join(root, 'work', 'src')
+    write_files(tree, int(size*1024*1024), generator, 'source')
+    url = 'file://'+repository+'/trunk/src'
+    subprocess.check_call(['svn', 'import', '-q', '-m', 'ADPAA source', tree, url])
+    shutil.rmtree(tree)
+    return url
+
+# Create root/http/simulations with the SIMDATA files, size megabytes.
+def make_simdata_directory(root, size, generator):
+    write_files(os.path.join(root, 'http', 'simulations'), int(size*1024*1024), generator, 'probe')
+
+# Serve directory over HTTP from a background thread; returns the server.
+# Files are sent with an ETag and, while server.ranges is set, as single
+# byte ranges on request (Range, If-Range), like the real download servers.
+# With server.break_every N the first transfer of every N (not counting
+# one byte probes) is cut off half way.
+def start_http_server(directory):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+        def log_message(self, format, *args):
+            pass
+        def do_GET(self):
+            path = self.translate_path(self.path)
+            if not os.path.isfile(path):
+                # Directory index pages.
+                return super().do_GET()
+            status = os.stat(path)
+            size = status.st_size
+            etag = '"%x-%x"' % (status.st_mtime_ns, size)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            start, end, code = 0, size-1, 200
+            requested = self.headers.get('Range', '')
+            if (self.server.ranges and requested.startswith('bytes=') and
+                    self.headers.get('If-Range', etag) == etag):
+                first, _, last = requested[6:].partition('-')
+                start = int(first)
+                if last:
+                    end = min(int(last), end)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.end_headers()
+                    return
+                code = 206
+            length = end+1-start
+            self.send_response(code)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(status.st_mtime))
+            self.send_header('Content-Length', str(length))
+            if self.server.ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+            if code == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            self.end_headers()
+            cut = False
+            if self.server.break_every and length > 1:
+                with self.server.lock:
+                    cut = self.server.transfers % self.server.break_every == 0
+                    self.server.transfers += 1
+            if cut:
+                length //= 2
+                self.close_connection = True
+            with open(path, 'rb') as input_file:
+                input_file.seek(start)
+                while length > 0:
+                    data = input_file.read(min(length, 64*1024))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    length -= len(data)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.ranges = True
+    server.break_every = 0
+    server.transfers = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Run CoPAS.py with arguments in the install root, returning the wall time,
+# exit code, peak resident memory (bytes, largest process) and its report.
+def run_copas(root, arguments, environment, log_name):
+    report_name = os.path.join(root, '.benchmark-report.json')
+    if os.path.exists(report_name):
+        os.remove(report_name)
+    command = [sys.executable, copas, 'notesting', '--report', report_name] + arguments
+    with open(log_name, 'a') as log_file:
+        log_file.write('$ '+' '.join(command)+'\n')
+        log_file.flush()
+        start = time.time()
+        process = subprocess.Popen(command, cwd=root, env=environment,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    try:
+        with open(report_name) as report_file:
+            report = json.load(report_file)
+    except (IOError, ValueError):
+        report = {}
+    return {'wall': round(wall, 3),
+            'status': process.returncode,
+            'peak_rss': usage.ru_maxrss*1024,
+            'bytes': report.get('bytes'),
+            'critical_path': report.get('critical_path')}
+
+# Number of the ADPAA.tar.gz release the HTTP server has.
+releases = [0]
+
+# Run the scenarios of one package set runs times, returning the median
+# result of each scenario.  A new ADPAA.tar.gz release updates its
+# checksum in environment, for the sets that follow.
+def run_set(work, name, environment, runs):
+    shared = environment
+    names = set_scenarios.get(name, scenarios)
+    results = dict((scenario, []) for scenario in names)
+    log_name = os.path.join(work, 'logs', name+'.log')
+    for run in range(runs):
+        base = os.path.join(work, 'runs', '%s-%d' % (name, run))
+        cache = os.path.join(base, 'cache')
+        environment = dict(environment, COPAS_CACHE=cache)
+        for scenario in names:
+            if scenario in ('cold', 'warm'):
+                root = os.path.join(base, scenario)
+                os.makedirs(root)
+            arguments = list(package_sets[name])
+            if scenario != 'fresh':
+                arguments += ['--fresh', '0']
+            if scenario == 'prefetched':
+                releases[0] += 1
+                version = 'release %d' % releases[0]
+                environment['COPAS_SHA256_ADPAA'] = release_adpaa_archive(work, version)
+                shared['COPAS_SHA256_ADPAA'] = environment['COPAS_SHA256_ADPAA']
+                run_copas(root, ['--fetch-only'] + arguments, environment, log_name)
+            result = run_copas(root, arguments, environment, log_name)
+            if scenario == 'prefetched':
+                try:
+                    with open(os.path.join(root, 'ADPAA', 'VERSION')) as version_file:
+                        installed = version_file.read()
+                except IOError:
+                    installed = None
+                if installed != version:
+                    with open(log_name, 'a') as log_file:
+                        log_file.write('Installed VERSION %r instead of %r.\n' % (installed, version))
+                    result['status'] = 1
+            results[scenario].append(result)
+    median = {}
+    for scenario, values in results.items():
+        values.sort(key=lambda result: result['wall'])
+        result = dict(values[len(values) // 2])
+        result['status'] = max(value['status'] for value in values)
+        result['peak_rss'] = max(value['peak_rss'] for value in values)
+        median[scenario] = result
+    return median
+
+def megabytes(value):
+    return '-' if value is None else '%.1f' % (value / 1e6)
+
+def print_results(results, baseline):
+    print ("  "+"set".ljust(24)+"scenario".ljust(12)+"status".rjust(7)+"wall s".rjust(9)+
+           "MB".rjust(9)+"RSS MB".rjust(9)+("  vs baseline" if baseline else ""))
+    for name, set_results in results.items():
+        for scenario, result in set_results.items():
+            line = ("  "+name.ljust(24)+scenario.ljust(12)+
+                    ("OK" if result['status'] == 0 else "FAILED").rjust(7)+
+                    ("%.2f" % result['wall']).rjust(9)+
+                    megabytes(result['bytes']).rjust(9)+megabytes(result['peak_rss']).rjust(9))
+            previous = baseline.get('sets', {}).get(name, {}).get(scenario) if baseline else None
+            if previous and previous.get('wall'):
+                line += "  %+.0f%%" % ((result['wall'] / previous['wall'] - 1)*100)
+            print (line)
+
+
+scale = 1.0
+runs = 1
+keep = None
+save = None
+baseline = None
+names = []
+index = 1
+while index < len(sys.argv):
+    param = sys.argv[index]
+    if param.startswith('-h'):
+        help_message()
+        exit()
+    elif param.startswith('--'):
+        option, _, value = param.partition('=')
+        if not value and index + 1 < len(sys.argv):
+            index += 1
+            value = sys.argv[index]
+        try:
+            if option == '--scale':
+                scale = float(value)
+            elif option == '--runs':
+                runs = int(value)
+            elif option == '--keep':
+                keep = value
+            elif option == '--save':
+                save = value
+            elif option == '--baseline':
+                with open(value) as baseline_file:
+                    baseline = json.load(baseline_file)
+            else:
+                print ("**  ERROR:  Unknown option "+param+".")
+                exit(1)
+        except (IOError, ValueError) as exc:
+            print ("**  ERROR:  Bad value for "+option+": "+str(exc))
+            exit(1)
+    elif param in package_sets:
+        names.append(param)
+    else:
+        print ("**  ERROR:  Unknown package set "+param+".")
+        exit(1)
+    index += 1
+if not names:
+    names = list(default_sets)
+if scale <= 0 or runs < 1:
+    print ("**  ERROR:  --scale and --runs must be positive.")
+    exit(1)
+
+if keep is not None:
+    work = os.path.abspath(keep)
+    os.makedirs(work)
+else:
+    work = tempfile.mkdtemp(prefix='copas-benchmark-')
+server = None
+try:
+    os.makedirs(os.path.join(work, 'logs'))
+    # Fixed seed, so every benchmark run gets the same stand-ins.
+    generator = random.Random(2016)
+    print ("Creating Local Stand-ins (scale %g):" % scale)
+    start = time.time()
+    environment = dict(os.environ)
+    for variable in list(environment):
+        if variable.startswith('COPAS_'):
+            del environment[variable]
+    environment['GIT_TERMINAL_PROMPT'] = '0'
+    for name, (size, commits) in sorted(git_packages.items()):
+        environment['COPAS_URL_'+name.upper()] = make_git_repository(
+            work, name, size*scale, commits, generator)
+    make_adpaa_archive(work, adpaa_size*scale, generator)
+    make_simdata_directory(work, simdata_size*scale, generator)
+    server = start_http_server(os.path.join(work, 'http'))
+    environment['COPAS_URL_ADPAA'] = 'http://127.0.0.1:%d/ADPAA.tar.gz' % server.server_address[1]
+    environment['COPAS_SHA256_ADPAA'] = release_adpaa_archive(work, 'release %d' % releases[0])
+    environment['COPAS_URL_SIMDATA'] = 'http://127.0.0.1:%d/simulations/' % server.server_address[1]
+    source_url = make_svn_repository(work, source_size*scale, generator)
+    if source_url is not None:
+        environment['COPAS_SOURCE_URL_ADPAA'] = source_url
+    elif 'adpaa-source' in names:
+        print ("  No svn commands, skipping the adpaa-source set.")
+        names.remove('adpaa-source')
+    print ("  Finished in %.1f s." % (time.time() - start))
+
+    results = {}
+    for name in names:
+        print ("Running Package Set "+name+":")
+        server.ranges, server.break_every = server_settings.get(name, (True, 0))
+        server.transfers = 0
+        results[name] = run_set(work, name, environment, runs)
+    print ("Results:")
+    print_results(results, baseline)
+    if save is not None:
+        with open(save, 'w') as save_file:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'scale': scale, 'runs': runs, 'sets': results},
+                      save_file, indent=1, sort_keys=True)
+    if keep is not None:
+        print ("  Logs in "+os.path.join(work, 'logs')+".")
+finally:
+    if server is not None:
+        server.shutdown()
+    if keep is None:
+        shutil.rmtree(work)